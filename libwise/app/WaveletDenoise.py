@@ -3,80 +3,11 @@ Created on May 23, 2012
 
 @author: fmertens
 '''
-import itertools
 import waveletsui
 import matplotlib.pyplot as plt
 
 from libwise import imgutils, plotutils, nputils, wtutils, wavelets, uiutils
-
-
-class Denoise(object):
-
-    def __init__(self, wavelet='db1', level=3, boundary="symm",
-                 dec=wtutils.uwt, rec=wtutils.uwt_inv, mode="hard", thread=None):
-        self.wavelet = wavelet
-        self.level = level
-        self.boundary = boundary
-        self.dec = dec
-        self.rec = rec
-        self.mode = mode
-        self._noise_std = None
-        self._noise_res = None
-        self.thread = thread
-
-    def decompose(self, img):
-        if self.dec == wtutils.uiwt:
-            dec = wtutils.wavedec(img, self.wavelet, self.level,
-                                  self.boundary, self.dec, thread=self.thread)
-            if dec is None:
-                return None
-            return [[k] for k in dec]
-        else:
-            return wtutils.wavedec2d(img, self.wavelet, self.level,
-                                     self.boundary, self.dec, thread=self.thread)
-
-    def recompose(self, coeffs, img):
-        if self.dec == wtutils.uiwt:
-            coeffs = [k[0] for k in coeffs]
-            return wtutils.waverec(coeffs, self.wavelet, self.boundary,
-                                   self.rec, img.shape, thread=self.thread)
-        else:
-            return wtutils.waverec2d(coeffs, self.wavelet, self.boundary,
-                                     self.rec, img.shape, thread=self.thread)
-
-    def get_noise_factor(self, frame, noise_sigma, noise):
-        if not self._noise_res:
-            if noise is None:
-                noise = nputils.gaussian_noise([300, 300], 0, noise_sigma)
-            res = self.decompose(noise)
-            if res is None:
-                return None
-            self._noise_res = [k.std() for k in itertools.chain(*res)]
-        return self._noise_res[frame]
-
-    def do(self, img, noise_sigma=None, noise=None, threashold_factor=4):
-        print "Denoising..."
-        if noise is None and noise_sigma is None:
-            noise_sigma = nputils.k_sigma_noise_estimation(img)
-
-        res = self.decompose(img)
-
-        if res is None:
-            return None
-
-        for (i, frame) in enumerate(itertools.chain(*res[:-1])):
-            noise_factor = self.get_noise_factor(i, noise_sigma, noise)
-            if noise_factor is None:
-                return None
-            threashold = threashold_factor * noise_factor
-            mask = (abs(frame) < threashold)
-            frame[mask] = 0
-            if self.mode == "soft":
-                frame[~mask] = frame[~mask] - threashold
-
-        denoised = self.recompose(res, img)
-        print "Done"
-        return denoised
+from libwise.wtutils import Denoise
 
 
 class WaveletDenoise(uiutils.Experience):
@@ -118,12 +49,7 @@ class WaveletDenoise(uiutils.Experience):
 
     def update(self, changed, thread):
         wavelet = self.wavelet.get()
-        if wavelets.TriangeWaveletFamily().is_from(wavelet) or wavelets.BSplineWaveletFamily().is_from(wavelet):
-            dec = wtutils.uiwt
-            rec = wtutils.uiwt_inv
-        else:
-            dec = wtutils.uwt
-            rec = wtutils.uwt_inv
+        dec, rec = wtutils.get_denoise_transforms(wavelet)
 
         denoise = Denoise(wavelet, self.scale.get(), self.boundary, dec, rec, mode=self.mode.get(), thread=thread)
         img = self.img.get()
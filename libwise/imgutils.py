@@ -39,6 +39,30 @@ import signalutils
 
 GALAXY_GIF_PATH = os.path.join(RESSOURCE_PATH, "aa.gif")
 
+# Default GaussianBeam convolution backend: 'fir' (sampled kernel), 'iir'
+# (recursive filter, see nputils.recursive_gaussian()), 'lattice' (rotated
+# beams by three 1D passes, see nputils.rotated_gaussian()), 'fft' (cached
+# analytic transfer function, see nputils.gaussian_transfer_function()) or
+# 'auto' ('iir' or 'lattice' when they apply)
+GAUSSIAN_BEAM_BACKEND = 'fir'
+
+# Smallest sigma (in pixel) for which the 'auto' backend use the recursive
+# filter, whose cost does not depend on the width
+RECURSIVE_GAUSSIAN_MIN_SIGMA = 5
+
+# Smallest minor axis sigma (in pixel) for which the 'lattice' and 'auto'
+# backends convolve a rotated elliptical GaussianBeam with three 1D passes
+# along lattice directions (see nputils.rotated_gaussian()) instead of the
+# sampled 2D kernel
+ROTATED_GAUSSIAN_MIN_SIGMA = 1.5
+
+# Kernels of the GaussianBeam, shared by all the beams of same bmaj, bmin, bpa
+CACHE_GAUSSIAN_BEAM_KERNEL = nputils.Cache(50)
+
+# Transfer functions of the 'fft' GaussianBeam backend, per beam and padded
+# image geometry
+CACHE_GAUSSIAN_BEAM_TRANSFER = nputils.Cache(8)
+
 cosmology.default_cosmology.set(cosmology.WMAP9)
 
 
@@ -296,13 +320,26 @@ class AbstractBeam(object):
     def __init__(self):
         self._beam = None
 
-    def convolve(self, img, boundary="zero"):
+    def convolve(self, img, boundary="zero", dtype=None, workers=None):
+        ''' img: an image, or a (N, H, W) stack of images convolved at once
+            dtype: working float type, default to nputils.FLOAT_DTYPE
+            workers: number of threads, default to nputils.WORKERS '''
+        img = nputils.as_float_array(img, dtype)
         if self._beam is None:
             self._beam = self.build_beam()
+        axes = (img.ndim - 2, img.ndim - 1)
         if isinstance(self._beam, tuple):
-            c = nputils.convolve(img, self._beam[0], mode='same', boundary=boundary, axis=0)
-            return nputils.convolve(c, self._beam[1], mode='same', boundary=boundary, axis=1)
-        return nputils.convolve(img, self._beam, mode='same', boundary=boundary)
+            c = nputils.convolve(img, self._beam[0], mode='same', boundary=boundary, axis=axes[0],
+                                 workers=workers)
+            return nputils.convolve(c, self._beam[1], mode='same', boundary=boundary, axis=axes[1],
+                                    workers=workers)
+        if img.ndim > 2 and self._beam.ndim == 2:
+            beam = self._beam.reshape((1,) * (img.ndim - 2) + self._beam.shape)
+            return nputils.fftconvolve(img, beam, mode='same', dtype=img.dtype)
+        if img.ndim > 2:
+            return nputils.convolve(img, self._beam, mode='same', boundary=boundary, axis=axes,
+                                    workers=workers)
+        return nputils.convolve(img, self._beam, mode='same', boundary=boundary, workers=workers)
 
     def build_beam(self):
         raise NotImplementedError()
@@ -319,7 +356,7 @@ class IdleBeam(AbstractBeam):
     def __str__(self):
         return "IdleBeam"
 
-    def convolve(self, img, boundary="zero"):
+    def convolve(self, img, boundary="zero", dtype=None, workers=None):
         return img
 
     def build_beam():
@@ -328,17 +365,98 @@ class IdleBeam(AbstractBeam):
 
 class GaussianBeam(AbstractBeam):
 
-    def __init__(self, bmaj, bmin, bpa=0):
-        ''' bmaj, bmin in pixel, bpa in radians'''
+    def __init__(self, bmaj, bmin, bpa=0, backend=None):
+        ''' bmaj, bmin in pixel, bpa in radians
+            backend: 'fir', 'iir', 'lattice', 'fft' or 'auto', default to
+                     GAUSSIAN_BEAM_BACKEND '''
         self.bmin = bmin
         self.bmaj = bmaj
         self.bpa = bpa
+        self.backend = backend
         AbstractBeam.__init__(self)
 
     def __str__(self):
         return "GaussianBeam:X:%s,Y:%s,A:%s" % (self.bmaj, self.bmin, self.bpa)
 
+    def use_recursive(self):
+        ''' True if the convolution is done with the recursive filter '''
+        backend = self.backend or GAUSSIAN_BEAM_BACKEND
+        if backend in ['fir', 'lattice', 'fft'] or (self.bpa != 0 and self.bmaj != self.bmin):
+            return False
+        sigma = nputils.gaussian_fwhm_to_sigma(min(self.bmaj, self.bmin))
+        if backend == 'auto':
+            return sigma >= RECURSIVE_GAUSSIAN_MIN_SIGMA
+        return sigma >= 0.5
+
+    def use_rotated(self):
+        ''' True if the convolution is done with nputils.rotated_gaussian() '''
+        backend = self.backend or GAUSSIAN_BEAM_BACKEND
+        if backend not in ['lattice', 'auto'] or self.bpa == 0 or self.bmaj == self.bmin:
+            return False
+        sigma = nputils.gaussian_fwhm_to_sigma(min(self.bmaj, self.bmin))
+        return sigma >= ROTATED_GAUSSIAN_MIN_SIGMA
+
+    def get_transfer_function(self, fft_shape, dtype):
+        ''' Return the cached real transfer function of the beam for the real
+            FFTs of shape fft_shape '''
+        key = (self.bmaj, self.bmin, self.bpa, tuple(fft_shape), np.dtype(dtype).str)
+        if key not in CACHE_GAUSSIAN_BEAM_TRANSFER:
+            sigmax = nputils.gaussian_fwhm_to_sigma(self.bmaj)
+            sigmay = nputils.gaussian_fwhm_to_sigma(self.bmin)
+            tf = nputils.gaussian_transfer_function(fft_shape, sigmax, sigmay, self.bpa, dtype=dtype)
+            tf.flags.writeable = False
+            CACHE_GAUSSIAN_BEAM_TRANSFER[key] = tf
+        return CACHE_GAUSSIAN_BEAM_TRANSFER[key]
+
+    def fft_convolve(self, img, boundary="zero", dtype=None):
+        ''' Convolve img (or a stack of images) by one real FFT, a multiply with
+            the cached transfer function and one inverse real FFT. img is
+            first extended by 4 sigma following boundary, 'wrap' being
+            exactly the circular convolution. '''
+        img = nputils.as_float_array(img, dtype)
+        shape = img.shape[-2:]
+        sigma = nputils.gaussian_fwhm_to_sigma(max(self.bmaj, self.bmin))
+        margin = nputils.gaussian_support(sigma) // 2
+        if boundary == 'wrap':
+            margin = 0
+            plan = nputils.get_fft_plan(shape, pad=False)
+        elif boundary == 'zero':
+            # the FFT padding is the extension
+            plan = nputils.get_fft_plan(np.array(shape) + margin)
+            margin = 0
+        else:
+            pad_mode = {'symm': 'symmetric', 'border': 'edge'}[boundary]
+            img = np.pad(img, [(0, 0)] * (img.ndim - 2) + [(margin, margin)] * 2, mode=pad_mode)
+            plan = nputils.get_fft_plan(img.shape[-2:])
+        tf = self.get_transfer_function(plan.fft_shape, img.dtype)
+        res = plan.irfftn(plan.rfftn(img) * tf).astype(img.dtype, copy=False)
+        return res[..., margin:margin + shape[0], margin:margin + shape[1]]
+
+    def convolve(self, img, boundary="zero", dtype=None, workers=None):
+        if (self.backend or GAUSSIAN_BEAM_BACKEND) == 'fft':
+            return self.fft_convolve(img, boundary=boundary, dtype=dtype)
+        sigmax = nputils.gaussian_fwhm_to_sigma(self.bmaj)
+        sigmay = nputils.gaussian_fwhm_to_sigma(self.bmin)
+        if self.use_rotated():
+            img = nputils.as_float_array(img, dtype)
+            return nputils.rotated_gaussian(img, sigmax, sigmay, self.bpa, boundary=boundary)
+        if not self.use_recursive():
+            return AbstractBeam.convolve(self, img, boundary=boundary, dtype=dtype, workers=workers)
+        img = nputils.as_float_array(img, dtype)
+        c = nputils.recursive_gaussian(img, sigmax, axis=img.ndim - 2, boundary=boundary)
+        return nputils.recursive_gaussian(c, sigmay, axis=img.ndim - 1, boundary=boundary)
+
     def build_beam(self):
+        ''' Return the kernel, shared by all the beams of same bmaj, bmin, bpa '''
+        key = (self.bmaj, self.bmin, self.bpa)
+        if key not in CACHE_GAUSSIAN_BEAM_KERNEL:
+            beam = self._build_beam()
+            for kernel in beam if isinstance(beam, tuple) else [beam]:
+                kernel.flags.writeable = False
+            CACHE_GAUSSIAN_BEAM_KERNEL[key] = beam
+        return CACHE_GAUSSIAN_BEAM_KERNEL[key]
+
+    def _build_beam(self):
         sigmax = nputils.gaussian_fwhm_to_sigma(self.bmaj)
         sigmay = nputils.gaussian_fwhm_to_sigma(self.bmin)
         support_x = nputils.get_next_odd(nputils.gaussian_support(sigmax))
@@ -1184,7 +1302,10 @@ class FitsImage(Image):
 
     GENERIC_HEADER_KEYS = ['TELESCOP', 'INTRUME', 'OBSERVER', 'OBJECT']
 
-    def __init__(self, file, freq_key="CRVAL3", float64=True, extension=0):
+    def __init__(self, file, freq_key="CRVAL3", float64=None, extension=0):
+        ''' float64: if True, data are converted to float64, if False data are
+            kept in their stored type, if None (default) data are converted to
+            the working float type nputils.FLOAT_DTYPE '''
         try:
             fits = pyfits.open(file)
         except Exception, e:
@@ -1205,7 +1326,9 @@ class FitsImage(Image):
             data = fits[extension].data
         else:
             raise ValueError("Not supported: naxis %s" % self.header['NAXIS'])
-        if float64:
+        if float64 is None:
+            data = nputils.as_float_array(data)
+        elif float64:
             data = data.astype(np.float64)
 
         self.wcs = pywcs.WCS(self.header, naxis=2, fobj=fits)
@@ -1332,6 +1455,49 @@ class FitsImage(Image):
         return hdu
 
 
+class FitsStripReader(object):
+    ''' Lazy row access to the 2D data of a FITS file, to process images that
+    do not fit in memory. Only the requested rows are read from the file.
+
+    reader[rows] returns the rows (slice or index array) converted to the
+    working float type. Each run of consecutive rows is read at once. '''
+
+    def __init__(self, file, extension=0, dtype=None):
+        self.file = file
+        self.fits = pyfits.open(file, memmap=True)
+        self.hdu = self.fits[extension]
+        naxis = self.hdu.header['NAXIS']
+        if naxis == 4:
+            self.prefix = (0, 0)
+        elif naxis == 2:
+            self.prefix = ()
+        else:
+            raise ValueError("Not supported: naxis %s" % naxis)
+        self.shape = tuple(self.hdu.shape[-2:])
+        self.dtype = nputils.get_float_dtype(dtype)
+
+    def __str__(self):
+        return "FitsStripReader(%s)" % os.path.basename(self.file)
+
+    def __getitem__(self, rows):
+        if isinstance(rows, slice):
+            rows = np.arange(*rows.indices(self.shape[0]))
+        rows = np.asarray(rows)
+        if rows.size == 0:
+            return np.zeros((0, self.shape[1]), dtype=self.dtype)
+        # read each run of consecutive rows separately, so that wrapped rows
+        # (e.g. [n - 1, 0, 1]) do not read the whole image in between
+        breaks = np.nonzero(np.diff(rows) != 1)[0] + 1
+        data = []
+        for run in np.split(rows, breaks):
+            section = self.hdu.section[self.prefix + (slice(run[0], run[-1] + 1),)]
+            data.append(nputils.as_float_array(section, self.dtype))
+        return np.concatenate(data)
+
+    def close(self):
+        self.fits.close()
+
+
 class StackedImage(FitsImage):
 
     KEY_N = 'STAN'
@@ -11,6 +11,9 @@ import wavelets_coefficients as wc
 
 from libwise import nputils
 
+# Wavelets interned by name, see get_wavelet()
+WAVELET_REGISTRY = dict()
+
 
 class WaveletFamilyBase(object):
 
@@ -42,7 +45,9 @@ class DiscreteWaveletFamilyBase(WaveletFamilyBase):
         WaveletFamilyBase.__init__(self, name, orders)
 
     def get_wavelet(self, order):
-        return DiscreteWaveletBase(order, self.orders[order], self)
+        if order not in WAVELET_REGISTRY:
+            WAVELET_REGISTRY[order] = DiscreteWaveletBase(order, self.orders[order], self)
+        return WAVELET_REGISTRY[order]
 
 
 class DaubechiesWaveletFamily(DiscreteWaveletFamilyBase):
@@ -95,28 +100,48 @@ class DiscreteWaveletBase(WaveletBase):
 
     def __init__(self, name, hkd, family):
         WaveletBase.__init__(self, name, family)
-        self.hk = hkd
-        self.gk = nputils.qmf(hkd)
+        # the wavelets are shared through WAVELET_REGISTRY: the filters, and
+        # the cached wavelet functions, are read only
+        self.hk = np.array(hkd, dtype=np.float64)
+        self.gk = np.array(nputils.qmf(hkd), dtype=np.float64)
+        self.hk.flags.writeable = False
+        self.gk.flags.writeable = False
 
         # for cache
         self.wavelet_fct = None
         self.wavelet_fct_level = 0
+        self.filters = dict()
 
     def get_max_level(self, data):
         # print data.shape, np.log2(np.array(data.shape).min()), len(self.get_dec_hk())
         return int(np.log2(np.array(data.shape).min() / len(self.get_dec_hk())))
 
-    def get_rec_hk(self):
-        return self.hk
-
-    def get_dec_hk(self):
-        return self.hk[::-1]
-
-    def get_rec_gk(self):
-        return self.gk
-
-    def get_dec_gk(self):
-        return self.gk[::-1]
+    def get_filters(self, dtype=None):
+        ''' Return the (dec_hk, dec_gk, rec_hk, rec_gk) filters as read only
+            contiguous arrays of the float type dtype (default to float64),
+            computed once per dtype '''
+        dtype = np.dtype(dtype)
+        if dtype.kind != 'f':
+            dtype = np.dtype(np.float64)
+        if dtype not in self.filters:
+            filters = [np.ascontiguousarray(f, dtype=dtype) for f in
+                       (self.hk[::-1], self.gk[::-1], self.hk, self.gk)]
+            for f in filters:
+                f.flags.writeable = False
+            self.filters[dtype] = tuple(filters)
+        return self.filters[dtype]
+
+    def get_rec_hk(self, dtype=None):
+        return self.get_filters(dtype)[2]
+
+    def get_dec_hk(self, dtype=None):
+        return self.get_filters(dtype)[0]
+
+    def get_rec_gk(self, dtype=None):
+        return self.get_filters(dtype)[3]
+
+    def get_dec_gk(self, dtype=None):
+        return self.get_filters(dtype)[1]
 
     def get_wavelet_fct(self, level):
         # try to get it from cache
@@ -165,10 +190,13 @@ class DiscreteWaveletBase(WaveletBase):
                 im = int(np.floor((point + 0.5)))
                 iv = (2 * point) % 1
                 v[point] = np.dot(m[im], v[iv])
-                phi[point * pow(2, level)::pow(2, level)] = np.real(v[point])
-                psi[point * pow(2, level)::pow(2, level)] = np.real(np.dot(p[im], v[iv]))
+                start = int(round(point * pow(2, level)))
+                phi[start::pow(2, level)] = np.real(v[point])
+                psi[start::pow(2, level)] = np.real(np.dot(p[im], v[iv]))
 
         # cache result
+        for a in (x, phi, psi):
+            a.flags.writeable = False
         self.wavelet_fct = (x, phi, psi)
         self.wavelet_fct_level = level
 
@@ -222,8 +250,9 @@ def get_all_wavelet_families():
 
 
 def get_wavelet(name):
-    for family in get_all_wavelet_families():
-        for order in family.get_orders():
-            if order == name:
-                return family.get_wavelet(order)
-    return None
+    if name not in WAVELET_REGISTRY:
+        for family in get_all_wavelet_families():
+            if name in family.orders:
+                return family.get_wavelet(name)
+        return None
+    return WAVELET_REGISTRY[name]
@@ -4,42 +4,70 @@ Created on Feb 13, 2012
 @author: fmertens
 '''
 
+import os
+import sys
+import json
+import time
+import itertools
+import multiprocessing
+
+import appdirs
 import numpy as np
 
 import nputils
 import imgutils
 import wavelets
 
+NOISE_FACTOR_FILE = os.path.join(appdirs.user_data_dir('libwise'), 'noise_factors.json')
+
+# Per scale noise factors: {key: [factor, ...]}. None until loaded from
+# NOISE_FACTOR_FILE
+NOISE_FACTOR_TABLE = None
+
+# Version of the saved noise factors. To be increased when a change of the
+# transforms or of the beam convolutions changes the factors, so that the
+# factors saved by a previous version are discarded
+NOISE_FACTOR_VERSION = 1
+
+# Default number of processes of batch_denoise(). -1: all cores
+DENOISE_WORKERS = 1
+
 
 def get_wavelet_obj(w):
     if isinstance(w, str):
-        return wavelets.get_wavelet(w)
+        wavelet = wavelets.get_wavelet(w)
+        if wavelet is None:
+            raise ValueError("Unknown wavelet %s" % w)
+        return wavelet
     if isinstance(w, wavelets.WaveletBase):
         return w
     raise ValueError("w is not a correct wavelet")
 
 
-def dwt(signal, wavelet, boundary, level=None, initial_signal=None, axis=None):
+def _filters_dtype(signal):
+    # the filters are taken in the float type of the signal, avoiding a cast
+    # of the kernel in each convolution
+    return np.asarray(signal).dtype
+
+
+def dwt(signal, wavelet, boundary, level=None, initial_signal=None, axis=None, workers=None):
     '''
     Perform a one level discrete wavelet transform.
 
     Result is len k + l + 1 if len(s) = 2k  and len(hkd) = 2l
         it is len k + l if len(s) = 2k + 1
 
+    Only the retained samples are computed (see nputils.convolve_downsample())
     '''
-    hkd = get_wavelet_obj(wavelet).get_dec_hk()
-    gkd = get_wavelet_obj(wavelet).get_dec_gk()
-
-    a_conv = nputils.convolve(signal, hkd, boundary, axis=axis)
-    d_conv = nputils.convolve(signal, gkd, boundary, axis=axis)
+    hkd, gkd = get_wavelet_obj(wavelet).get_filters(_filters_dtype(signal))[:2]
 
-    a = nputils.downsample(a_conv, 2, oddeven=1, axis=axis)
-    d = nputils.downsample(d_conv, 2, oddeven=1, axis=axis)
+    a = nputils.convolve_downsample(signal, hkd, boundary, axis=axis, workers=workers)
+    d = nputils.convolve_downsample(signal, gkd, boundary, axis=axis, workers=workers)
 
     return (a, d)
 
 
-def dwt_inv(a, d, wavelet, boundary, level=None, axis=None):
+def dwt_inv(a, d, wavelet, boundary, level=None, axis=None, workers=None):
     '''
     Perform a one level inverse discrete wavelet transform.
 
@@ -54,88 +82,333 @@ def dwt_inv(a, d, wavelet, boundary, level=None, axis=None):
     if len(a) == len(d) + 1:
         a = a[:-1]
 
-    hkr = get_wavelet_obj(wavelet).get_rec_hk()
-    gkr = get_wavelet_obj(wavelet).get_rec_gk()
+    hkr, gkr = get_wavelet_obj(wavelet).get_filters(_filters_dtype(a))[2:]
 
-    a_upsample = nputils.upsample(a, 2, oddeven=1, lastzero=True, axis=axis)
-    d_upsample = nputils.upsample(d, 2, oddeven=1, lastzero=True, axis=axis)
+    c = nputils.upsample_convolve(a, hkr, axis=axis, workers=workers)
+    c += nputils.upsample_convolve(d, gkr, axis=axis, workers=workers)
 
-    c1 = nputils.convolve(a_upsample, hkr, boundary, axis=axis, mode='valid')
-    c2 = nputils.convolve(d_upsample, gkr, boundary, axis=axis, mode='valid')
+    return c
 
-    return c1 + c2
 
+def uwt(signal, wavelet, boundary, level, initial_signal=None, axis=None, workers=None):
+    hkd, gkd = get_wavelet_obj(wavelet).get_filters(_filters_dtype(signal))[:2]
 
-def uwt(signal, wavelet, boundary, level, initial_signal=None, axis=None):
-    hkd = nputils.atrou(get_wavelet_obj(wavelet).get_dec_hk(), pow(2, level))
-    gkd = nputils.atrou(get_wavelet_obj(wavelet).get_dec_gk(), pow(2, level))
-
-    a = nputils.convolve(signal, hkd, boundary, axis=axis)
-    d = nputils.convolve(signal, gkd, boundary, axis=axis)
+    a = nputils.convolve_dilated(signal, hkd, pow(2, level), boundary, axis=axis, workers=workers)
+    d = nputils.convolve_dilated(signal, gkd, pow(2, level), boundary, axis=axis, workers=workers)
 
     return (a, d)
 
 
-def uwt_inv(a, d, wavelet, boundary, level, initial_signal=None, axis=None):
-    hkr = nputils.atrou(get_wavelet_obj(wavelet).get_rec_hk(), pow(2, level))
-    gkr = nputils.atrou(get_wavelet_obj(wavelet).get_rec_gk(), pow(2, level))
+def uwt_inv(a, d, wavelet, boundary, level, initial_signal=None, axis=None, workers=None):
+    hkr, gkr = get_wavelet_obj(wavelet).get_filters(_filters_dtype(a))[2:]
 
-    c1 = nputils.convolve(a, hkr, boundary, axis=axis, mode="valid")
-    c2 = nputils.convolve(d, gkr, boundary, axis=axis, mode="valid")
+    c1 = nputils.convolve_dilated(a, hkr, pow(2, level), boundary, axis=axis, mode="valid",
+                                  workers=workers)
+    c2 = nputils.convolve_dilated(d, gkr, pow(2, level), boundary, axis=axis, mode="valid",
+                                  workers=workers)
 
     return 1 / 2. * (c1 + c2)
 
 
-def uiwt(signal, wavelet, boundary, level, initial_signal=None, axis=None):
-    hkd = nputils.atrou(get_wavelet_obj(wavelet).get_dec_hk(), pow(2, level))
+def uiwt(signal, wavelet, boundary, level, initial_signal=None, axis=None, workers=None):
+    hkd = get_wavelet_obj(wavelet).get_dec_hk(_filters_dtype(signal))
 
-    a = nputils.convolve(signal, hkd, boundary, axis=axis, mode='same')
+    a = nputils.convolve_dilated(signal, hkd, pow(2, level), boundary, axis=axis, mode='same',
+                                 workers=workers)
 
     d = signal - a
 
     return (a, d)
 
 
-def uimwt(signal, wavelet, boundary, level, initial_signal=None, axis=None):
-    hkd = nputils.atrou(get_wavelet_obj(wavelet).get_dec_hk(), pow(2, level))
+def uimwt(signal, wavelet, boundary, level, initial_signal=None, axis=None, workers=None):
+    hkd = get_wavelet_obj(wavelet).get_dec_hk(_filters_dtype(signal))
 
-    a = nputils.convolve(signal, hkd, boundary, axis=axis, mode='same')
-    a2 = nputils.convolve(a, hkd, boundary, axis=axis, mode='same')
+    a = nputils.convolve_dilated(signal, hkd, pow(2, level), boundary, axis=axis, mode='same',
+                                 workers=workers)
+    a2 = nputils.convolve_dilated(a, hkd, pow(2, level), boundary, axis=axis, mode='same',
+                                  workers=workers)
 
     d = signal - a2
 
     return (a, d)
 
 
-def uiwt_inv(a, d, wavelet, boundary, level, axis=None):
+def uiwt_inv(a, d, wavelet, boundary, level, axis=None, workers=None):
     return a + d
 
 
+def _workers_kargs(workers):
+    # custom dec / rec functions may not support the workers argument
+    if workers is None:
+        return dict()
+    return {'workers': workers}
+
+
+def _stack_axis(signal, axis, stack):
+    ''' The axis argument of the transforms. If stack is True, signal is a
+        stack of signals along its first axis, which is never filtered. '''
+    if not stack:
+        return axis
+    if axis is None:
+        return tuple(range(1, signal.ndim))
+    return axis + 1
+
+
+def _stack_chunks(signal):
+    ''' Slices of a stack of signals small enough to be decomposed at once
+        through all the levels while staying in cache '''
+    n = max(1, nputils.LINES_BLOCK_SIZE // max(1, signal[0].nbytes))
+    return [slice(i, i + n) for i in range(0, len(signal), n)]
+
+
+def _decompose_stack(fct, signal, thread=None):
+    ''' Decompose the stack of signals by chunks with fct, which return a
+        list of (n, ...) arrays, and gather the results '''
+    res = None
+    for chunk in _stack_chunks(signal):
+        if thread and not thread.is_alive():
+            return None
+        coefs = fct(signal[chunk])
+        if coefs is None:
+            return None
+        if res is None:
+            res = [np.empty((len(signal),) + c.shape[1:], dtype=c.dtype) for c in coefs]
+        for r, c in zip(res, coefs):
+            r[chunk] = c
+    return res
+
+
 def wavedec(signal, wavelet, level, boundary="symm",
-            dec=dwt, axis=None, thread=None):
+            dec=dwt, axis=None, thread=None, dtype=None, out=None, workers=None, stack=False):
+    ''' dtype: working float type, default to nputils.FLOAT_DTYPE
+        out: if set, the scales are written into this (level + 1,) +
+             signal.shape array, see wavedec_cube()
+        workers: number of threads filtering the lines, default to
+                 nputils.WORKERS
+        stack: if True, signal is a (N, ...) stack of signals, decomposed at
+               once. Each scale is then a (N, ...) array, and axis refers to
+               the axes of the individual signals. '''
+    if out is not None:
+        return wavedec_cube(signal, wavelet, level, boundary=boundary, dec=dec, axis=axis,
+                            thread=thread, dtype=dtype, out=out, workers=workers, stack=stack)
     # max_level = get_wavelet_obj(wavelet).get_max_level(signal)
     # if level > max_level:
         # raise ValueError("Level should be < %s" % max_level)
+    signal = nputils.as_float_array(signal, dtype)
+    if stack and dec in (uiwt, uimwt):
+        # the scales are computed in place, in a scales first cube
+        cube = np.empty((int(level) + 1,) + signal.shape, dtype=signal.dtype)
+        if wavedec_cube(signal, wavelet, level, boundary=boundary, dec=dec, axis=axis,
+                        thread=thread, out=np.rollaxis(cube, 1), workers=workers,
+                        stack=True) is None:
+            return None
+        return list(cube)
+    if stack and len(_stack_chunks(signal)) > 1:
+        return _decompose_stack(lambda s: wavedec(s, wavelet, level, boundary=boundary, dec=dec,
+                                                  axis=axis, workers=workers, stack=True),
+                                signal, thread)
+    axis = _stack_axis(signal, axis, stack)
     res = []
     a = signal
     for j in range(int(level)):
         if thread and not thread.is_alive():
             return None
-        a, d = dec(a, wavelet, boundary, j, initial_signal=signal, axis=axis)
+        a, d = dec(a, wavelet, boundary, j, initial_signal=signal, axis=axis,
+                   **_workers_kargs(workers))
         res.append(d)
     res.append(a)
     return res
 
 
-def dogdec(signal, widths=None, angle=0, ellipticity=1, boundary="symm"):
+def wavedec_cube(signal, wavelet, level, boundary="symm", dec=uiwt, axis=None,
+                 thread=None, dtype=None, out=None, workers=None, stack=False):
+    ''' Same as wavedec() for the decompositions that keep the shape of the
+    signal (uiwt, uimwt), but all the scales are written into a single
+    (level + 1,) + signal.shape array, out if provided, else a new one.
+
+    If stack is True, signal is a (N, ...) stack of signals decomposed at
+    once, and the cube is (N, level + 1, ...).
+
+    With uiwt and uimwt, the approximations are computed directly in the
+    slots of the cube, with two scratch buffers reused across levels. '''
+    if out is not None and dtype is None:
+        dtype = out.dtype
+    signal = nputils.as_float_array(signal, dtype)
+    if stack:
+        shape = signal.shape[:1] + (int(level) + 1,) + signal.shape[1:]
+    else:
+        shape = (int(level) + 1,) + signal.shape
+    if out is None:
+        out = np.empty(shape, dtype=signal.dtype)
+    elif out.shape != shape:
+        raise ValueError("out should be of shape %s" % (shape,))
+    res = out
+    if stack and len(_stack_chunks(signal)) > 1:
+        for chunk in _stack_chunks(signal):
+            if wavedec_cube(signal[chunk], wavelet, level, boundary=boundary, dec=dec, axis=axis,
+                            thread=thread, out=out[chunk], workers=workers, stack=True) is None:
+                return None
+        return res
+    if stack:
+        # scales first view: out[j] is the (N, ...) scale j
+        out = np.rollaxis(out, 1)
+    axis = _stack_axis(signal, axis, stack)
+
+    if dec not in (uiwt, uimwt):
+        a = signal
+        for j in range(int(level)):
+            if thread and not thread.is_alive():
+                return None
+            a, d = dec(a, wavelet, boundary, j, initial_signal=signal, axis=axis,
+                       **_workers_kargs(workers))
+            if d.shape != signal.shape:
+                raise ValueError("The decomposition does not preserve the shape of the signal")
+            out[j] = d
+        out[-1] = a
+        return res
+
+    hkd = get_wavelet_obj(wavelet).get_dec_hk(signal.dtype)
+    if axis is None:
+        axes = range(signal.ndim)
+    elif isinstance(axis, tuple):
+        axes = list(axis)
+    else:
+        axes = [axis]
+    scratch = [np.empty_like(signal), np.empty_like(signal)]
+
+    def lowpass(a, j, res):
+        # separable filtering, ping-ponging the intermediate axes in scratch
+        for i, dim in enumerate(axes[:-1]):
+            a = nputils.convolve_dilated(a, hkd, pow(2, j), boundary, axis=dim,
+                                         mode='same', out=scratch[i % 2], workers=workers)
+        return nputils.convolve_dilated(a, hkd, pow(2, j), boundary, axis=axes[-1],
+                                        mode='same', out=res, workers=workers)
+
+    out[0] = signal
+    for j in range(int(level)):
+        if thread and not thread.is_alive():
+            return None
+        # out[j] holds the approximation of level j
+        lowpass(out[j], j, out[j + 1])
+        if dec is uimwt:
+            a2 = lowpass(out[j + 1], j, scratch[(len(axes) - 1) % 2])
+            out[j] -= a2
+        else:
+            out[j] -= out[j + 1]
+    return res
+
+
+def wavedec_memmap(signal, wavelet, level, filename, boundary="symm", dec=uiwt, axis=None,
+                   thread=None, dtype=None, workers=None):
+    ''' Same as wavedec_cube(), but the cube is a memory mapped .npy file
+    created at filename. The scales are computed in place in the file, so the
+    memory usage is a few signal sized buffers whatever the level.
+
+    Return the np.memmap, see open_wavedec() to map it back later. '''
+    signal = nputils.as_float_array(signal, dtype)
+    shape = (int(level) + 1,) + signal.shape
+    out = np.lib.format.open_memmap(filename, mode='w+', dtype=signal.dtype, shape=shape)
+    res = wavedec_cube(signal, wavelet, level, boundary=boundary, dec=dec, axis=axis,
+                       thread=thread, out=out, workers=workers)
+    out.flush()
+    if res is None:
+        return None
+    return out
+
+
+def open_wavedec(filename, mode='r'):
+    ''' Lazily map a decomposition saved by wavedec_memmap(). Individual
+        scales (cube[j]) or tiles (cube[j, x0:x1, y0:y1]) are only read from
+        disk when accessed. '''
+    return np.load(filename, mmap_mode=mode)
+
+
+def get_strip_halo(wavelet, level, dec=uiwt):
+    ''' Number of rows on each side of a strip needed by wavedec_strips() so
+        that the decomposition of its central rows is exact '''
+    m = len(get_wavelet_obj(wavelet).get_dec_hk())
+    n_conv = 2 if dec is uimwt else 1
+    return sum([n_conv * (((m - 1) * pow(2, j) + 1) // 2) for j in range(int(level))])
+
+
+def wavedec_strips(source, wavelet, level, out, strip_size=256, boundary="symm", dec=uiwt,
+                   thread=None, dtype=None, workers=None):
+    ''' Decomposition of a 2D image by horizontal strips, for images that do
+    not fit in memory.
+
+    Each strip is read from source with a halo of get_strip_halo() rows
+    (taken following boundary at the image borders), decomposed with
+    wavedec_cube(), and its central rows are written to out. The result is
+    identical to the in-core wavedec_cube() for the symm, zero and wrap
+    boundaries, with a memory usage bounded by the strip size.
+
+    source: an array (or np.memmap), an Image, or an imgutils.FitsStripReader
+    out: a (level + 1, H, W) array like, typically a np.memmap. If a string,
+         a .npy memmap is created at this filename.
+    dec: uiwt or uimwt '''
+    if dec not in (uiwt, uimwt):
+        raise ValueError("Only uiwt and uimwt decompositions can be done by strips")
+    if isinstance(source, imgutils.Image):
+        source = source.get_data()
+    n_rows, n_cols = source.shape
+    shape = (int(level) + 1, n_rows, n_cols)
+    if isinstance(out, basestring):
+        out = np.lib.format.open_memmap(out, mode='w+', dtype=nputils.get_float_dtype(dtype),
+                                        shape=shape)
+    if tuple(out.shape) != shape:
+        raise ValueError("out should be of shape %s" % (shape,))
+
+    halo = get_strip_halo(wavelet, level, dec)
+    for start in range(0, n_rows, strip_size):
+        if thread and not thread.is_alive():
+            return None
+        stop = min(start + strip_size, n_rows)
+        if boundary == 'wrap':
+            rows = np.arange(start - halo, stop + halo) % n_rows
+            first = halo
+        else:
+            rows = np.arange(max(start - halo, 0), min(stop + halo, n_rows))
+            first = start - rows[0]
+        strip = nputils.as_float_array(source[rows], dtype)
+        cube = wavedec_cube(strip, wavelet, level, boundary=boundary, dec=dec, workers=workers)
+        out[:, start:stop] = cube[:, first:first + stop - start]
+
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
+
+
+def dogdec(signal, widths=None, angle=0, ellipticity=1, boundary="symm", dtype=None,
+           cascade=False, backend=None):
+    ''' signal: an image, or a (N, H, W) stack of images decomposed at once
+        cascade: if True, each smoothed image is computed from the previous
+                 one, with a beam of width sqrt(w_i ** 2 - w_i-1 ** 2).
+                 widths should be increasing.
+        backend: convolution backend of the beams, see imgutils.GaussianBeam '''
+    signal = nputils.as_float_array(signal, dtype)
     if widths is None:
-        widths = np.arange(1, min(signal.shape) / 4)
-    beams =  [imgutils.GaussianBeam(ellipticity * w, w, bpa=angle) for w in widths]
-    filtered = [b.convolve(signal, boundary=boundary) for b in beams]
+        widths = np.arange(1, min(signal.shape[-2:]) / 4)
+    if signal.ndim == 3 and len(_stack_chunks(signal)) > 1:
+        return _decompose_stack(lambda s: dogdec(s, widths, angle=angle, ellipticity=ellipticity,
+                                                 boundary=boundary, dtype=signal.dtype,
+                                                 cascade=cascade, backend=backend), signal)
+    beams = [imgutils.GaussianBeam(ellipticity * w, w, bpa=angle, backend=backend) for w in widths]
+    if cascade:
+        if np.any(np.diff(widths) <= 0):
+            raise ValueError("widths should be increasing in cascade mode")
+        filtered = [beams[0].convolve(signal, boundary=boundary, dtype=signal.dtype)]
+        for w1, w2 in nputils.nwise(widths, 2):
+            w = np.sqrt(w2 ** 2 - w1 ** 2)
+            beam = imgutils.GaussianBeam(ellipticity * w, w, bpa=angle, backend=backend)
+            filtered.append(beam.convolve(filtered[-1], boundary=boundary, dtype=signal.dtype))
+    else:
+        filtered = [b.convolve(signal, boundary=boundary, dtype=signal.dtype) for b in beams]
     res = [(el[0] - el[-1]) for el in nputils.nwise(filtered, 2)]
     for s in res:
         s[s <= 0] = 0
-    res = [s - b2.convolve(s, boundary=boundary) for (s, (b1, b2)) in zip(res, nputils.nwise(beams, 2))]
+    res = [s - b2.convolve(s, boundary=boundary, dtype=signal.dtype)
+           for (s, (b1, b2)) in zip(res, nputils.nwise(beams, 2))]
     # res = [b1.convolve(s, boundary=boundary) - b2.convolve(s, boundary=boundary) for (s, (b1, b2)) in zip(res, nputils.nwise(beams, 2))]
     return res
 
@@ -143,7 +416,7 @@ def dogdec(signal, widths=None, angle=0, ellipticity=1, boundary="symm"):
 def pyramiddec(signal, widths=None, angle=0, ellipticity=1, boundary="symm"):
     if widths is None:
         widths = np.arange(1, min(signal.shape) / 4)
-    beams =  [imgutils.GaussianBeam(ellipticity * w, w, angle=angle) for w in widths]
+    beams =  [imgutils.GaussianBeam(ellipticity * w, w, bpa=angle) for w in widths]
     min_scale = beams[0].convolve(signal, boundary=boundary) - beams[1].convolve(signal, boundary=boundary)
     filtered_min = [b.convolve(min_scale, boundary=boundary) for b in beams]
     filtered_all = [b.convolve(signal, boundary=boundary) for b in beams]
@@ -151,57 +424,128 @@ def pyramiddec(signal, widths=None, angle=0, ellipticity=1, boundary="symm"):
     return [v - k for k, v in  zip(filtered_min, dog)]
 
 
+def _pyramid_filter(wavelet, dtype):
+    hk = get_wavelet_obj(wavelet).get_dec_hk(dtype)
+    return hk / hk.sum()
+
+
+def gaussian_pyramid(signal, level, wavelet="b3", boundary="symm", dtype=None, workers=None):
+    ''' Return [g_0 = signal, g_1, ..., g_level], g_k+1 being g_k smoothed by
+    the scaling filter of wavelet (normalized to a unit gain) and decimated
+    by 2 along each axis (see nputils.pyramid_reduce()). '''
+    signal = nputils.as_float_array(signal, dtype)
+    hk = _pyramid_filter(wavelet, signal.dtype)
+    res = [signal]
+    for j in range(int(level)):
+        res.append(nputils.pyramid_reduce(res[-1], hk, boundary, workers=workers))
+    return res
+
+
+def lapdec(signal, level, wavelet="b3", boundary="symm", dtype=None, thread=None, workers=None):
+    ''' Laplacian pyramid decomposition: return [l_0, ..., l_level-1, g_level],
+    with l_k = g_k - expand(g_k+1) (see gaussian_pyramid()).
+
+    Scale k is decimated by 2 ** k along each axis, so the decomposition of
+    an image is about 4/3 of its size, and costs about 4/3 of a one level
+    decomposition. Use pyramid_to_pixel() to map the coordinates of a scale
+    to the full resolution. laprec() is the exact inverse. '''
+    signal = nputils.as_float_array(signal, dtype)
+    hk = _pyramid_filter(wavelet, signal.dtype)
+    res = []
+    g = signal
+    for j in range(int(level)):
+        if thread and not thread.is_alive():
+            return None
+        coarse = nputils.pyramid_reduce(g, hk, boundary, workers=workers)
+        res.append(g - nputils.pyramid_expand(coarse, hk, g.shape, boundary, workers=workers))
+        g = coarse
+    res.append(g)
+    return res
+
+
+def laprec(coefs, wavelet="b3", boundary="symm", dtype=None, thread=None, workers=None):
+    ''' Exact reconstruction of a decomposition done with lapdec() '''
+    g = nputils.as_float_array(coefs[-1], dtype)
+    hk = _pyramid_filter(wavelet, g.dtype)
+    for l in coefs[-2::-1]:
+        if thread and not thread.is_alive():
+            return None
+        g = l + nputils.pyramid_expand(g, hk, l.shape, boundary, workers=workers)
+    return g
+
+
+def pyramid_to_pixel(coords, level):
+    ''' Map coordinates on the scale level of a pyramid (see lapdec()) to the
+        full resolution pixel coordinates '''
+    return np.asarray(coords) * pow(2, level)
+
+
+def pixel_to_pyramid(coords, level):
+    ''' Map full resolution pixel coordinates to the scale level of a
+        pyramid. Inverse of pyramid_to_pixel() '''
+    return np.asarray(coords) / float(pow(2, level))
+
+
 def waverec(coefs, wavelet, boundary="symm", rec=dwt_inv,
-            axis=None, shape=None, thread=None):
-    a = coefs[-1]
+            axis=None, shape=None, thread=None, dtype=None, workers=None):
+    a = nputils.as_float_array(coefs[-1], dtype)
     for j in range(len(coefs) - 2, -1, -1):
         if thread and not thread.is_alive():
             return None
-        a = rec(a, coefs[j], wavelet, boundary, j, axis=axis)
+        d = nputils.as_float_array(coefs[j], a.dtype)
+        a = rec(a, d, wavelet, boundary, j, axis=axis, **_workers_kargs(workers))
     if shape and shape != a.shape:
         # See idwt() for an explaination
-        a = nputils.index(a, np.s_[:-1], axis)
+        a = nputils.get_index(a, np.s_[:-1], axis)
     return a
 
 
-def dec2d(img, wavelet, boundary, dec, level):
-    rows_a, rows_d = dec(img, wavelet, boundary, level, axis=0)
-    a, d1 = dec(rows_a, wavelet, boundary, level, axis=1)
-    d2, d3 = dec(rows_d, wavelet, boundary, level, axis=1)
+def dec2d(img, wavelet, boundary, dec, level, workers=None, stack=False):
+    kargs = _workers_kargs(workers)
+    ax0, ax1 = (img.ndim - 2, img.ndim - 1) if stack else (0, 1)
+    rows_a, rows_d = dec(img, wavelet, boundary, level, axis=ax0, **kargs)
+    a, d1 = dec(rows_a, wavelet, boundary, level, axis=ax1, **kargs)
+    d2, d3 = dec(rows_d, wavelet, boundary, level, axis=ax1, **kargs)
     return (a, d1, d2, d3)
 
 
-def wavedec2d(img, wavelet, level, boundary="symm", dec=dwt, thread=None):
-    a = img
+def wavedec2d(img, wavelet, level, boundary="symm", dec=dwt, thread=None, dtype=None,
+              workers=None, stack=False):
+    ''' stack: if True, img is a (N, H, W) stack of images decomposed at
+               once, each coefficient being a (N, h, w) array '''
+    a = nputils.as_float_array(img, dtype)
     res = []
     for j in range(int(level)):
         if thread and not thread.is_alive():
             return None
-        a, d1, d2, d3 = dec2d(a, wavelet, boundary, dec, j)
+        a, d1, d2, d3 = dec2d(a, wavelet, boundary, dec, j, workers=workers, stack=stack)
         res.append([d1, d2, d3])
     res.append(a)
     return res
 
 
-def rec2d(a, d, wavelet, boundary, rec, level):
+def rec2d(a, d, wavelet, boundary, rec, level, workers=None):
     d1, d2, d3 = d
+    kargs = _workers_kargs(workers)
 
     if a.shape != d1.shape:
-        a = nputils.index(a, np.s_[:-1])
-    temp_a = rec(a, d1, wavelet, boundary, level, axis=1)
-    temp_d = rec(d2, d3, wavelet, boundary, level, axis=1)
-    img = rec(temp_a, temp_d, wavelet, boundary, level, axis=0)
+        a = nputils.get_index(a, np.s_[:-1])
+    temp_a = rec(a, d1, wavelet, boundary, level, axis=1, **kargs)
+    temp_d = rec(d2, d3, wavelet, boundary, level, axis=1, **kargs)
+    img = rec(temp_a, temp_d, wavelet, boundary, level, axis=0, **kargs)
     return img
 
 
-def waverec2d(coefs, wavelet, boundary="symm", rec=dwt_inv, shape=None, thread=None):
-    a = coefs[-1]
+def waverec2d(coefs, wavelet, boundary="symm", rec=dwt_inv, shape=None, thread=None,
+              dtype=None, workers=None):
+    a = nputils.as_float_array(coefs[-1], dtype)
     for j in range(len(coefs) - 2, -1, -1):
         if thread and not thread.is_alive():
             return None
-        a = rec2d(a, coefs[j], wavelet, boundary, rec, j)
+        d = [nputils.as_float_array(k, a.dtype) for k in coefs[j]]
+        a = rec2d(a, d, wavelet, boundary, rec, j, workers=workers)
     if shape and shape != a.shape:
-        a = nputils.index(a, np.s_[:-1])
+        a = nputils.get_index(a, np.s_[:-1])
     return a
 
 
@@ -251,13 +595,124 @@ def get_noise_factor_from_data(wavelet, level, dec, data):
     return [nputils.k_sigma_noise_estimation(scale) for scale in scales[:-1]]
 
 
-def get_noise_factor(wavelet, level, dec, beam=None):
-    # n = (250000)
-    n = (200, 200)
-    background = nputils.gaussian_noise(n, 0, 1)
+def save_noise_factors(filename=NOISE_FACTOR_FILE):
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    with open(filename, 'w') as fd:
+        json.dump({'version': NOISE_FACTOR_VERSION, 'table': NOISE_FACTOR_TABLE or dict()}, fd, indent=1)
+
+
+def load_noise_factors(filename=NOISE_FACTOR_FILE):
+    ''' Load the noise factors saved by save_noise_factors().
+        Return False if no factors are available, or if they were saved by
+        an other NOISE_FACTOR_VERSION '''
+    global NOISE_FACTOR_TABLE
+    NOISE_FACTOR_TABLE = dict()
+    try:
+        with open(filename) as fd:
+            data = json.load(fd)
+        if data.get('version') != NOISE_FACTOR_VERSION:
+            return False
+        for key, factors in data['table'].items():
+            NOISE_FACTOR_TABLE[str(key)] = [float(f) for f in factors]
+        return True
+    except (IOError, ValueError, KeyError, AttributeError, TypeError):
+        return False
+
+
+def _transform_name(dec):
+    # only functions of the modules of the library are identified by their
+    # name: lambdas, closures, methods and functions of scripts are not
+    name = getattr(dec, '__name__', None)
+    module = sys.modules.get(getattr(dec, '__module__', None))
+    if name is None or module is None or module.__name__ == '__main__' \
+            or getattr(module, name, None) is not dec:
+        return None
+    return '%s.%s' % (module.__name__, name)
+
+
+def _noise_factor_key(dec, beam, **params):
+    # None if the factors can not be identified by their parameters
+    if beam is None or isinstance(beam, imgutils.IdleBeam):
+        beam_key = None
+    elif isinstance(beam, imgutils.GaussianBeam):
+        backend = beam.backend or imgutils.GAUSSIAN_BEAM_BACKEND
+        beam_key = (round(beam.bmaj, 6), round(beam.bmin, 6), round(beam.bpa, 6), backend)
+    else:
+        return None
+    dec_name = _transform_name(dec)
+    if dec_name is None:
+        return None
+    items = []
+    for name, value in sorted(params.items()):
+        if isinstance(value, (np.ndarray, list, tuple)):
+            value = tuple([round(float(v), 6) for v in value])
+        elif isinstance(value, float):
+            value = round(value, 6)
+        items.append((name, value))
+    return repr((dec_name, beam_key) + tuple(items))
+
+
+def _cached_noise_factor(key, compute):
+    if NOISE_FACTOR_TABLE is None:
+        load_noise_factors()
+    if key is None:
+        return list(compute())
+    if key not in NOISE_FACTOR_TABLE:
+        NOISE_FACTOR_TABLE[key] = [float(f) for f in compute()]
+    return list(NOISE_FACTOR_TABLE[key])
+
+
+def _impulse_response(wavelet, level, dec, beam=None, dec2d=False):
+    # the transforms are linear, so each scale of the decomposition of the
+    # (beam convolved) impulse is the equivalent filter of this scale
+    n_conv = 2 if dec is uimwt else 1
+    m = len(get_wavelet_obj(wavelet).get_dec_hk())
+    support = sum([n_conv * (m - 1) * pow(2, j) for j in range(int(level))])
+    if beam is not None:
+        kernel = beam.build_beam()
+        support += max([len(k) for k in kernel]) if isinstance(kernel, tuple) else max(kernel.shape)
+    impulse = np.zeros([2 * support + 1] * 2)
+    impulse[support, support] = 1
     if beam is not None:
-        background = beam.convolve(background)
-    return get_noise_factor_from_background(wavelet, level, dec, background)
+        impulse = beam.convolve(impulse, boundary='zero')
+    if dec2d:
+        scales = wavedec2d(impulse, wavelet, level, boundary='zero', dec=dec)
+        return [d for details in scales[:-1] for d in details]
+    return wavedec(impulse, wavelet, level, boundary='zero', dec=dec)[:-1]
+
+
+def get_noise_factor(wavelet, level, dec, beam=None, boundary="symm", dec2d=False):
+    ''' Return the std of each detail scale of the decomposition of a 2D
+    unit gaussian noise, convolved by beam if set.
+
+    For the linear undecimated transforms (uiwt, uimwt, uwt), the factors
+    are exact: the std of a filtered white noise is the l2 norm of the
+    filter, and the equivalent filters are obtained from the decomposition
+    of an impulse. Other transforms are measured on a simulated noise field.
+
+    The factors only depend on (dec, wavelet, level, boundary, beam) and are
+    memoized in NOISE_FACTOR_TABLE, which is loaded from NOISE_FACTOR_FILE on
+    first use. Use save_noise_factors() to persist the computed factors.
+
+    dec2d: if True, the factors of the 3 details of each level of
+           wavedec2d() are returned. '''
+    def compute():
+        if dec in (uiwt, uimwt, uwt):
+            scales = _impulse_response(wavelet, level, dec, beam=beam, dec2d=dec2d)
+            return [np.sqrt((scale ** 2).sum()) for scale in scales]
+        background = nputils.gaussian_noise((200, 200), 0, 1)
+        if beam is not None:
+            background = beam.convolve(background)
+        if dec2d:
+            scales = wavedec2d(background, wavelet, level, boundary=boundary, dec=dec)
+            return [d.std() for details in scales[:-1] for d in details]
+        return get_noise_factor_from_background(wavelet, level, dec, background)
+
+    key = _noise_factor_key(dec, beam, wavelet=get_wavelet_obj(wavelet).get_name(),
+                            level=int(level), boundary=boundary, dec2d=dec2d)
+    return _cached_noise_factor(key, compute)
 
 
 def wave_noise_factor(bg, wavelet, level, dec, beam=None):
@@ -269,14 +724,189 @@ def wave_noise_factor(bg, wavelet, level, dec, beam=None):
 
 
 def dec_noise_factor(dec, bg, beam=None, **kargs):
-    if not isinstance(bg, np.ndarray):
-        n = (200, 200)
-        bg = nputils.gaussian_noise(n, 0, bg)
+    ''' bg: a background array, or the std of the gaussian noise. The factors
+        of a unit noise are memoized as in get_noise_factor(). '''
+    if isinstance(bg, np.ndarray):
+        scales = dec(bg, **kargs)
+        return [scale.std() for scale in scales[:-1]]
+
+    def compute():
+        noise = nputils.gaussian_noise((200, 200), 0, 1)
         if beam is not None:
-            bg = beam.convolve(bg)
-    scales = dec(bg, **kargs)
-    return [scale.std() for scale in scales[:-1]]
+            noise = beam.convolve(noise)
+        scales = dec(noise, **kargs)
+        return [scale.std() for scale in scales[:-1]]
+
+    return [bg * f for f in _cached_noise_factor(_noise_factor_key(dec, beam, **kargs), compute)]
 
 
 def dog_noise_factor(bg, widths=None, angle=0, ellipticity=1, beam=None):
     return dec_noise_factor(dogdec, bg, beam=beam, widths=widths, angle=angle, ellipticity=ellipticity)
+
+
+def get_denoise_transforms(wavelet):
+    ''' Return the (dec, rec) transforms used to denoise with wavelet: the
+        isotropic undecimated transform for the triangle and b-spline
+        families, the undecimated transform otherwise '''
+    wavelet = get_wavelet_obj(wavelet)
+    if wavelets.TriangeWaveletFamily().is_from(wavelet) or wavelets.BSplineWaveletFamily().is_from(wavelet):
+        return uiwt, uiwt_inv
+    return uwt, uwt_inv
+
+
+class Denoise(object):
+    ''' Denoising by thresholding of the wavelet coefficients.
+
+    The noise factors of a unit noise are computed once (see
+    get_noise_factor()) and kept, so the same Denoise can be reused for many
+    images, and is sent with them to the worker processes of
+    batch_denoise(). '''
+
+    def __init__(self, wavelet='db1', level=3, boundary="symm",
+                 dec=uwt, rec=uwt_inv, mode="hard", thread=None):
+        self.wavelet = wavelet
+        self.level = level
+        self.boundary = boundary
+        self.dec = dec
+        self.rec = rec
+        self.mode = mode
+        self._noise_factors = None
+        self._noise_res = None
+        self.thread = thread
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['thread'] = None
+        return state
+
+    def decompose(self, img):
+        if self.dec == uiwt:
+            dec = wavedec(img, self.wavelet, self.level,
+                          self.boundary, self.dec, thread=self.thread)
+            if dec is None:
+                return None
+            return [[k] for k in dec]
+        else:
+            return wavedec2d(img, self.wavelet, self.level,
+                             self.boundary, self.dec, thread=self.thread)
+
+    def recompose(self, coeffs, img):
+        if self.dec == uiwt:
+            coeffs = [k[0] for k in coeffs]
+            return waverec(coeffs, self.wavelet, self.boundary,
+                           self.rec, img.shape, thread=self.thread)
+        else:
+            return waverec2d(coeffs, self.wavelet, self.boundary,
+                             self.rec, img.shape, thread=self.thread)
+
+    def get_noise_factors(self):
+        ''' Return the noise factors of each detail frame for a unit noise '''
+        if self._noise_factors is None:
+            self._noise_factors = get_noise_factor(self.wavelet, self.level, self.dec,
+                                                   boundary=self.boundary,
+                                                   dec2d=self.dec != uiwt)
+        return self._noise_factors
+
+    def get_noise_factor(self, frame, noise_sigma, noise):
+        if noise is None:
+            return noise_sigma * self.get_noise_factors()[frame]
+        if not self._noise_res:
+            res = self.decompose(noise)
+            if res is None:
+                return None
+            self._noise_res = [k.std() for k in itertools.chain(*res)]
+        return self._noise_res[frame]
+
+    def do(self, img, noise_sigma=None, noise=None, threashold_factor=4):
+        if noise is None and noise_sigma is None:
+            noise_sigma = nputils.k_sigma_noise_estimation(img)
+
+        res = self.decompose(img)
+
+        if res is None:
+            return None
+
+        for (i, frame) in enumerate(itertools.chain(*res[:-1])):
+            noise_factor = self.get_noise_factor(i, noise_sigma, noise)
+            if noise_factor is None:
+                return None
+            threashold = threashold_factor * noise_factor
+            mask = (abs(frame) < threashold)
+            frame[mask] = 0
+            if self.mode == "soft":
+                frame[~mask] = frame[~mask] - threashold
+
+        return self.recompose(res, img)
+
+
+def _denoise_file(args):
+    denoise, filename, output_filename, noise_sigma, threashold_factor = args
+    try:
+        img = imgutils.guess_and_open(filename)
+        img.set_data(denoise.do(img.get_data(), noise_sigma=noise_sigma,
+                                threashold_factor=threashold_factor))
+        img.save_to_fits(output_filename)
+    except Exception, e:
+        return filename, output_filename, "%s: %s" % (e.__class__.__name__, e)
+    return filename, output_filename, None
+
+
+def _init_denoise_worker():
+    # the thread pools of the parent are copied by the fork, without their
+    # threads: each worker filters in its single thread
+    nputils.THREAD_POOLS.clear()
+    nputils.set_workers(1)
+
+
+def batch_denoise(denoise, filenames, output_filenames, noise_sigma=None, threashold_factor=4,
+                  workers=None, progress=None):
+    ''' Denoise the images filenames with the Denoise denoise, and save the
+        results to the FITS output_filenames (see imgutils.Image.save_to_fits()).
+
+        noise_sigma: the noise std, default to an estimation per image
+        workers: number of processes, -1: all cores, default to DENOISE_WORKERS
+        progress: called after each file with (n_done, n_files, result,
+                  elapsed_time)
+
+        The noise factors are computed once, and shared with the workers.
+        Return the list of (filename, output_filename, error) in completion
+        order, error being None on success. Raise ValueError if several files
+        would be saved to the same output file. '''
+    if len(filenames) != len(output_filenames):
+        raise ValueError("filenames and output_filenames should have the same length")
+    seen = dict()
+    for filename, output_filename in zip(filenames, output_filenames):
+        key = os.path.normcase(os.path.abspath(output_filename))
+        if key in seen:
+            raise ValueError("%s and %s would both be saved to %s" % (seen[key], filename, output_filename))
+        seen[key] = filename
+    denoise.get_noise_factors()
+    tasks = [(denoise, filename, output_filename, noise_sigma, threashold_factor)
+             for filename, output_filename in zip(filenames, output_filenames)]
+    if workers is None:
+        workers = DENOISE_WORKERS
+    if workers < 0:
+        workers = multiprocessing.cpu_count()
+    workers = min(max(1, int(workers)), max(1, len(tasks)))
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, initializer=_init_denoise_worker)
+        results_iter = pool.imap_unordered(_denoise_file, tasks)
+    else:
+        results_iter = itertools.imap(_denoise_file, tasks)
+
+    results = []
+    start = time.time()
+    try:
+        for result in results_iter:
+            results.append(result)
+            if progress is not None:
+                progress(len(results), len(tasks), result, time.time() - start)
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return results
@@ -6,8 +6,10 @@ Created on Feb 10, 2012
 import datetime
 import numpy as np
 from scipy.signal import convolve2d
+from scipy.ndimage import fourier_shift
+from scipy.ndimage.filters import maximum_filter, maximum_filter1d
 
-from libwise import nputils
+from libwise import nputils, imgutils, signalutils
 # from libwise import nputils_c
 from libwise.nputils import assert_equal, assert_raise
 
@@ -250,6 +252,210 @@ def test_convolve():
     assert_equal(nputils.convolve(a, v[0], boundary='zero', mode='same'), convolve2d(a, v * v.T, mode='same'))
 
 
+def test_convolve_full_axis():
+    a = np.random.random([30, 17])
+    for v in [np.random.random(1), np.random.random(4), np.random.random(7)]:
+        for boundary in ['zero', 'symm', 'wrap']:
+            exp = np.array([nputils._convolve_1d_full(l, v, boundary=boundary) for l in a])
+            assert np.allclose(nputils.convolve(a, v, boundary, axis=1), exp)
+            exp = np.array([nputils._convolve_1d_full(l, v, boundary=boundary) for l in a.T]).T
+            assert np.allclose(nputils.convolve(a, v, boundary, axis=0), exp)
+
+    v = np.random.random(5)
+    out = np.zeros([34, 17])
+    res = nputils.convolve_full_axis(a, v, axis=0, boundary='border', out=out)
+    assert res is out
+    aext = np.concatenate([a[:1]] * 4 + [a] + [a[-1:]] * 4)
+    assert np.allclose(out, np.array([np.convolve(l, v, mode='valid') for l in aext.T]).T)
+
+    b = np.random.random([5, 6, 7])
+    exp = np.apply_along_axis(lambda l: np.convolve(l, v), 1, b)
+    assert np.allclose(nputils.convolve_full_axis(b, v, axis=1, boundary='zero'), exp)
+
+    res = nputils.convolve(np.arange(10), [0.25, 0.5, 0.25], mode='full')
+    assert np.allclose(res, nputils._convolve_1d_full(np.arange(10.), np.array([0.25, 0.5, 0.25])))
+    assert res[0] == 0.25
+
+
+def test_polyphase_convolve():
+    for shape in [[21], [20, 17], [9, 8, 7]]:
+        a = np.random.random(shape)
+        for v in [np.random.random(2), np.random.random(5), np.random.random(8)]:
+            for axis in [None] + range(a.ndim):
+                for boundary in ['zero', 'symm', 'wrap']:
+                    if a.ndim > 2:
+                        if axis is None:
+                            continue
+                        exp = nputils.convolve_full_axis(a, v, axis, boundary)
+                    else:
+                        exp = nputils.convolve(a, v, boundary, axis=axis)
+                    exp = nputils.downsample(exp, 2, oddeven=1, axis=axis)
+                    res = nputils.convolve_downsample(a, v, boundary, axis=axis)
+                    assert res.shape == exp.shape
+                    assert np.allclose(res, exp)
+                if a.ndim > 2:
+                    continue
+                up = nputils.upsample(a, 2, oddeven=1, lastzero=True, axis=axis)
+                exp = nputils.convolve(up, v, 'zero', axis=axis, mode='valid')
+                res = nputils.upsample_convolve(a, v, axis=axis)
+                assert res.shape == exp.shape
+                assert np.allclose(res, exp)
+
+
+def test_convolve_dilated():
+    for shape in [[40], [33, 20]]:
+        a = np.random.random(shape)
+        for v in [np.random.random(2), np.random.random(5)]:
+            for dilation in [1, 2, 8, 16]:
+                for boundary in ['zero', 'symm', 'wrap']:
+                    for mode in ['full', 'same']:
+                        for axis in [None] + range(a.ndim):
+                            exp = nputils.convolve(a, nputils.atrou(v, dilation), boundary, axis=axis, mode=mode)
+                            res = nputils.convolve_dilated(a, v, dilation, boundary, axis=axis, mode=mode)
+                            assert res.shape == exp.shape
+                            assert np.allclose(res, exp)
+                exp = nputils.convolve(a, nputils.atrou(v, dilation), axis=0, mode='valid')
+                assert np.allclose(nputils.convolve_dilated(a, v, dilation, axis=0, mode='valid'), exp)
+
+
+def test_workers():
+    a = np.random.random([37, 50, 3])
+    v = np.random.random(5)
+    for axis in range(a.ndim):
+        exp = nputils.convolve_full_axis(a, v, axis=axis, workers=1)
+        assert np.array_equal(nputils.convolve_full_axis(a, v, axis=axis, workers=4), exp)
+        exp = nputils.convolve_dilated(a, v, 4, axis=axis, workers=1)
+        assert np.array_equal(nputils.convolve_dilated(a, v, 4, axis=axis, workers=4), exp)
+        exp = nputils.convolve_downsample(a, v, 'symm', axis=axis, workers=1)
+        assert np.array_equal(nputils.convolve_downsample(a, v, 'symm', axis=axis, workers=4), exp)
+
+    a = a[:, :, 0]
+    for mode in ['full', 'same', 'valid']:
+        exp = nputils.convolve(a, v, mode=mode, workers=1)
+        assert np.array_equal(nputils.convolve(a, v, mode=mode, workers=3), exp)
+
+    nputils.set_workers(2)
+    try:
+        assert nputils.get_workers() == 2
+        assert np.array_equal(nputils.convolve(a, v, mode='same'), nputils.convolve(a, v, mode='same', workers=1))
+    finally:
+        nputils.set_workers(1)
+    assert nputils.get_workers(-1) >= 1
+    stack = np.zeros([8, 256, 256])
+    assert not nputils.split_lines(stack, 2, workers=1)
+    assert nputils.split_lines(stack, 2, workers=2)
+
+
+def test_convolve_stack():
+    stack = np.random.random([4, 30, 20])
+    v = np.random.random(5)
+    for mode in ['full', 'same', 'valid']:
+        res = nputils.convolve(stack, v, mode=mode, axis=(1, 2))
+        assert np.allclose(res[2], nputils.convolve(stack[2], v, mode=mode))
+    res = nputils.convolve_dilated(stack, v, 2, axis=(1, 2), mode='same')
+    assert np.allclose(res[1], nputils.convolve_dilated(stack[1], v, 2, mode='same'))
+    assert np.allclose(nputils.fftconvolve(stack, v[np.newaxis, np.newaxis, :]),
+                       nputils.convolve(stack, v, boundary='zero', axis=2, mode='same'))
+
+
+def test_recursive_gaussian():
+    for sigma in [1, 3, 10]:
+        impulse = np.zeros(301)
+        impulse[150] = 1
+        res = nputils.recursive_gaussian(impulse, sigma, boundary='zero')
+        x = np.arange(301) - 150
+        exp = np.exp(-x ** 2 / (2. * sigma ** 2))
+        exp /= exp.sum()
+        assert abs(res - exp).max() < 1e-3 * exp.max()
+
+    a = np.random.random([40, 50])
+    kernel = signalutils.gaussian(25, width=nputils.gaussian_sigma_to_fwhm(3))
+    kernel /= kernel.sum()
+    for boundary in ['zero', 'symm', 'wrap']:
+        exp = nputils.convolve(a, kernel, mode='same', boundary=boundary)
+        res = nputils.recursive_gaussian(a, 3, boundary=boundary)
+        assert res.shape == a.shape
+        assert np.allclose(res, exp, atol=1e-3)
+    assert nputils.recursive_gaussian(a.astype(np.float32), 2).dtype == np.float32
+    nputils.assert_raise(ValueError, nputils.recursive_gaussian, a, 0.2)
+
+
+def test_rotated_gaussian():
+    for bmaj, bmin, bpa in [(10, 4, 0.5), (10, 4, -1.2), (20, 6, 2.5), (30, 5, 0.1)]:
+        sigmax = nputils.gaussian_fwhm_to_sigma(bmaj)
+        sigmay = nputils.gaussian_fwhm_to_sigma(bmin)
+        c, s = np.cos(bpa), np.sin(bpa)
+        r = np.array([[c, -s], [s, c]])
+        cov = np.dot(r.T, np.dot(np.diag([sigmax ** 2, sigmay ** 2]), r))
+        decomposition = nputils.get_lattice_gaussian_decomposition(sigmax, sigmay, bpa)
+        assert np.allclose(sum(v * np.outer(d, d) for d, v in decomposition), cov)
+        assert min(v for d, v in decomposition) >= 0
+
+        impulse = np.zeros([151, 151])
+        impulse[75, 75] = 1
+        res = nputils.rotated_gaussian(impulse, sigmax, sigmay, bpa, boundary='zero')
+        exp = imgutils.gaussian(151, width=[bmaj, bmin], angle=bpa)
+        exp /= exp.sum()
+        assert abs(res - exp).max() < 1e-2 * exp.max()
+
+        a = np.random.random([2, 100, 90])
+        beam = imgutils.GaussianBeam(bmaj, bmin, bpa=bpa)
+        assert not beam.use_rotated()
+        assert np.array_equal(beam.convolve(a[1]), imgutils.AbstractBeam.convolve(beam, a[1]))
+        beam = imgutils.GaussianBeam(bmaj, bmin, bpa=bpa, backend='lattice')
+        assert beam.use_rotated()
+        exp = imgutils.AbstractBeam.convolve(beam, a[1], boundary='zero')
+        res = beam.convolve(a, boundary='zero')
+        assert res.shape == a.shape
+        assert np.allclose(res[1], exp, atol=5e-3)
+        res = beam.convolve(a, boundary='symm')
+        assert np.allclose(res[1, 40:-40, 40:-40], exp[40:-40, 40:-40], atol=5e-3)
+    assert not imgutils.GaussianBeam(4, 3, bpa=0.5, backend='lattice').use_rotated()
+    assert imgutils.GaussianBeam(10, 4, bpa=0.5, backend='auto').use_rotated()
+
+
+def test_gaussian_beam_fft():
+    sigmax, sigmay, angle = 3, 1.5, 0.5
+    x, y = np.meshgrid(np.fft.fftfreq(64) * 64, np.fft.fftfreq(48) * 48, indexing='ij')
+    kernel = nputils.gaussian_fct(0, 1, [0, 0], [sigmax, sigmay], angle)([x, y])
+    tf = nputils.gaussian_transfer_function((64, 48), sigmax, sigmay, angle)
+    assert np.allclose(tf, np.fft.rfftn(kernel / kernel.sum()))
+
+    a = np.random.random([2, 60, 50])
+    for bmaj, bmin, bpa in [(8, 3, 0), (6, 6, 0), (8, 4, 0.5)]:
+        beam = imgutils.GaussianBeam(bmaj, bmin, bpa=bpa, backend='fft')
+        boundaries = ['zero', 'symm', 'wrap'] if bpa == 0 else ['zero']
+        for boundary in boundaries:
+            res = beam.convolve(a, boundary=boundary)
+            assert res.shape == a.shape
+            exp = imgutils.AbstractBeam.convolve(beam, a[1], boundary=boundary)
+            assert np.allclose(res[1], exp, atol=1e-4)
+        assert beam.convolve(a[0], dtype=np.float32).dtype == np.float32
+        assert len([k for k in imgutils.CACHE_GAUSSIAN_BEAM_TRANSFER if k[:3] == (bmaj, bmin, bpa)]) > 0
+        assert imgutils.GaussianBeam(bmaj, bmin, bpa=bpa).build_beam() is beam.build_beam()
+
+
+def test_pyramid_reduce_expand():
+    for n in [1, 2, 7, 20]:
+        for m in [2, 3, 5]:
+            a = np.random.random(n)
+            v = np.random.random(m)
+            for boundary in ['zero', 'symm', 'wrap']:
+                exp = nputils.convolve_dilated(a, v, 1, boundary, axis=0, mode='same')[::2]
+                assert np.allclose(nputils.pyramid_reduce(a, v, boundary, axis=0), exp)
+
+            c = np.random.random((n + 1) // 2)
+            exp = 2 * nputils.convolve_dilated(nputils.upsample(c, 2)[:n], v, 1, 'zero', axis=0,
+                                               mode='same')
+            assert np.allclose(nputils.pyramid_expand(c, v, [n], 'zero', axis=0), exp)
+
+    a = np.random.random([31, 20])
+    c = nputils.pyramid_reduce(a, np.ones(5) / 5.)
+    assert c.shape == (16, 10)
+    assert nputils.pyramid_expand(c, np.ones(5) / 5., a.shape).shape == a.shape
+    nputils.assert_raise(ValueError, nputils.pyramid_expand, c, np.ones(5), [40, 20])
+
+
 def test_fill_at():
     a = np.arange(25).reshape([5, 5]) * 10
     b = np.arange(9).reshape([3, 3]) * 0.1
@@ -413,6 +619,70 @@ def test_local_sum():
     assert np.allclose(ls, ls_conv)
 
 
+def test_register():
+    ref = imgutils.gaussian(64, width=6, center=[30, 33]) + 0.3 * imgutils.gaussian(64, width=3, center=[20, 40])
+    shifts = [[2.37, -4.61], [-7.2, 0.25], [0, 0]]
+    imgs = [np.fft.ifftn(fourier_shift(np.fft.fftn(ref), shift)).real for shift in shifts]
+
+    assert np.allclose(nputils.register(ref, imgs[0], upsample=100), [-2.37, 4.61])
+    assert np.allclose(nputils.register(ref, imgs, upsample=20), - np.array(shifts), atol=0.05)
+    assert np.allclose(nputils.register(ref, imgs[1]), [7, 0])
+    assert np.allclose(nputils.register(ref, imgs[0], upsample=10, phase=True), [-2.4, 4.6])
+
+    x = np.random.random([6, 7])
+    assert np.allclose(nputils.dftups(np.fft.fftn(x)), x * x.size)
+
+
+def test_integral_image():
+    for shape, window in [([20], [4]), ([20, 15], [5, 4]), ([20, 15], [3, 6]), ([8, 7, 9], [3, 2, 4])]:
+        a = np.random.random(shape)
+        integral = nputils.IntegralImage(a)
+        for mode in ['same', 'full', 'valid']:
+            n = nputils.local_sum(np.ones_like(a), window, mode=mode)
+            s = nputils.local_sum(a, window, mode=mode)
+            s2 = nputils.local_sum(a ** 2, window, mode=mode)
+            assert np.allclose(integral.local_count(window, mode), n)
+            assert np.allclose(integral.local_sum(window, mode), s)
+            assert np.allclose(integral.local_sum2(window, mode), s2)
+            assert np.allclose(integral.local_mean(window, mode), s / n)
+            assert np.allclose(integral.local_var(window, mode), np.clip(s2 / n - (s / n) ** 2, 0, None))
+
+    x = np.random.random([40, 35])
+    y = np.random.random([5, 4])
+    integral = nputils.IntegralImage(x)
+    assert np.allclose(nputils.norm_xcorr2(x, y, integral=integral), nputils.norm_xcorr2(x, y))
+    assert np.allclose(nputils.zero_ssd_fast(x, y, integral=integral), nputils.zero_ssd_fast(x, y))
+
+    noise = nputils.gaussian_noise([200, 200], 0, 2)
+    assert abs(nputils.k_sigma_noise_estimation(noise, integral=nputils.IntegralImage(noise)) - 2) < 0.2
+
+
+def test_noise_calibration(tmpdir):
+    nputils.NOISE_CALIBRATION_TABLE = dict()
+    beam = imgutils.GaussianBeam(3, 2, 0.5)
+    factor = nputils.get_noise_calibration(2, beam=beam)
+    assert len(nputils.NOISE_CALIBRATION_TABLE) == 1
+    assert nputils.get_noise_calibration(2, beam=beam) == factor
+    nputils.get_noise_calibration(2)
+    nputils.get_noise_calibration(2, high_pass='box')
+    assert len(nputils.NOISE_CALIBRATION_TABLE) == 3
+
+    filename = str(tmpdir.join('noise_calibration.json'))
+    nputils.save_noise_calibration(filename)
+    table = nputils.NOISE_CALIBRATION_TABLE
+    assert nputils.load_noise_calibration(filename)
+    assert nputils.NOISE_CALIBRATION_TABLE == table
+    assert not nputils.load_noise_calibration(filename + '.missing')
+    assert nputils.NOISE_CALIBRATION_TABLE == dict()
+
+    noise = nputils.gaussian_noise([300, 300], 0, 2)
+    assert abs(nputils.mad_std(noise) - 2) < 0.05
+    noise[:10] = 1000
+    assert abs(nputils.mad_std(noise) - 2) < 0.1
+    assert abs(nputils.k_sigma_noise_estimation(noise, method='mad') - 2) < 0.2
+    assert abs(nputils.k_sigma_noise_estimation(noise) - 2) < 0.2
+
+
 def test_xcorr_fast():
     a = np.random.random([5, 4])
     b = np.random.random([5, 4])
@@ -420,6 +690,73 @@ def test_xcorr_fast():
     assert np.allclose(nputils.xcorr_fast(a, b, method='fft'), nputils.xcorr_fast(a, b, method='conv'))
 
 
+def test_float32_precision():
+    x = np.random.random([40, 35]).astype(np.float32)
+    y = np.random.random([5, 4]).astype(np.float32)
+
+    assert nputils.local_sum(x, y.shape, dtype=np.float32).dtype == np.float32
+    assert nputils.xcorr_fast(x, y, dtype=np.float32).dtype == np.float32
+    assert nputils.convolve(x, y[0], axis=0, mode='same').dtype == np.float32
+
+    corr = nputils.norm_xcorr2(x, y, dtype=np.float32)
+    assert corr.dtype == np.float32
+    assert np.allclose(corr, nputils.norm_xcorr2(x, y), atol=1e-3)
+    assert nputils.norm_xcorr2(x, y).dtype == np.float64
+
+    try:
+        nputils.set_float_dtype(np.float32)
+        assert nputils.norm_xcorr2(x, y).dtype == np.float32
+        assert nputils.CorrelationEngine(x).norm_xcorr2(y).dtype == np.float32
+    finally:
+        nputils.set_float_dtype(np.float64)
+
+
+def test_next_fast_len():
+    assert [nputils.next_fast_len(n) for n in [1, 2, 7, 11, 13, 17, 1030, 2049]] == \
+        [1, 2, 8, 12, 15, 18, 1080, 2160]
+    for n in range(1, 500):
+        m = nputils.next_fast_len(n)
+        assert m >= n
+        while m % 2 == 0:
+            m /= 2
+        while m % 3 == 0:
+            m /= 3
+        while m % 5 == 0:
+            m /= 5
+        assert m == 1
+
+
+def test_xcorr_fast_large():
+    a = np.random.random([2, 2100])
+    b = np.random.random([2, 5])
+
+    assert nputils.get_fft_plan([3, 2104]).fft_shape == (3, 2160)
+    assert nputils.get_fft_shape([11, 9]) == (12, 10)
+    assert np.allclose(nputils.xcorr_fast(a, b, method='fft'), nputils.xcorr_fast(a, b, method='conv'))
+
+
+def test_autotune_convolution(tmpdir):
+    filename = str(tmpdir.join('conv_tuning.json'))
+    k_conv, k_fft = nputils.K_CONV, nputils.K_FFT
+    try:
+        nputils.autotune_convolution(shapes=[(32, 32)], kernel_shapes=[(3, 3), (9, 9)],
+                                     repeat=1, filename=filename)
+        table = nputils.CONV_DECISION_TABLE
+        assert len(table) == 2
+        assert nputils.get_conv_method((32, 32), (3, 3), (64, 64)) == table[(2, 10, 3)]
+
+        nputils.set_conv_tuning(k_conv, k_fft)
+        assert nputils.load_conv_tuning(filename)
+        assert nputils.CONV_DECISION_TABLE == table
+        assert not nputils.load_conv_tuning(filename + '.missing')
+
+        a = np.random.random([32, 32])
+        b = np.random.random([9, 9])
+        assert np.allclose(nputils.xcorr_fast(a, b), nputils.xcorr_fast(a, b, method='fft'))
+    finally:
+        nputils.set_conv_tuning(k_conv, k_fft)
+
+
 def test_ssd_fast():
     # a = np.random.random([5, 4])
     # b = np.random.random([5, 4])
@@ -454,6 +791,42 @@ def test_norm_xcorr():
     assert False
 
 
+def test_correlation_engine():
+    x = np.random.random([40, 35])
+    engine = nputils.CorrelationEngine(x)
+
+    for shape in [[5, 4], [6, 7], [5, 4]]:
+        y = np.random.random(shape)
+        w = np.random.random(shape)
+        for mode in ['same', 'full', 'valid']:
+            assert np.allclose(engine.xcorr(y, mode=mode),
+                               nputils.xcorr_fast(x, y, mode=mode, method='fft'))
+            assert np.allclose(engine.norm_xcorr2(y, mode=mode),
+                               nputils.norm_xcorr2(x, y, mode=mode, method='fft'))
+            assert np.allclose(engine.zero_mean_xcorr2(y, mode=mode),
+                               nputils.zero_mean_xcorr2(x, y, mode=mode, method='fft'))
+            assert np.allclose(engine.ssd(y, mode=mode),
+                               nputils.ssd_fast(x, y, mode=mode, method='fft'))
+            assert np.allclose(engine.weighted_ssd(y, w, mode=mode),
+                               nputils.weighted_ssd_fast(x, y, w, mode=mode, method='fft'))
+        assert np.allclose(engine.zero_ssd(y), nputils.zero_ssd_fast(x, y, method='fft'))
+
+
+def test_norm_xcorr2_stack():
+    x = np.random.random([40, 35])
+    ys = np.random.random([7, 5, 6])
+
+    for mode in ['same', 'full', 'valid']:
+        res = nputils.norm_xcorr2_stack(x, ys, mode=mode, chunk_size=3)
+        assert res.shape[0] == len(ys)
+        for y, r in zip(ys, res):
+            assert np.allclose(r, nputils.norm_xcorr2(x, y, mode=mode, method='fft'))
+
+    ys = [np.random.random([5, 6]), np.random.random([3, 4])]
+    res = nputils.norm_xcorr2_stack(x, ys)
+    assert np.allclose(res[1], nputils.norm_xcorr2(x, nputils.resize(ys[1], [5, 6]), method='fft'))
+
+
 def test_crop_threshold():
     l = np.zeros([5, 5])
     l[2, 2] = 2
@@ -668,6 +1041,59 @@ def test_find_peaks():
     assert [k.tolist() for k in nputils.find_peaks(a, 2, 1, exclude_border=False)] == [[0, 0], [5, 5]]
 
 
+def test_max_filter():
+    a = np.random.random([30, 27])
+    for size in [1, 2, 3, 4, 7, 30, 41]:
+        assert np.allclose(nputils.max_filter1d(a, size, axis=0), maximum_filter1d(a, size, axis=0))
+        assert np.allclose(nputils.max_filter1d(a, size, axis=1), maximum_filter1d(a, size, axis=1))
+    assert np.allclose(nputils.max_filter(a, [5, 3]), maximum_filter(a, [5, 3]))
+    b = np.random.randint(0, 100, [10, 11, 12])
+    assert np.array_equal(nputils.max_filter(b, 4), maximum_filter(b, 4))
+
+
+def test_find_peaks_box():
+    a = np.zeros([20, 20])
+    assert nputils.find_peaks(a, 2, 1, footprint='box') == []
+
+    a[5, 5] = 1
+    a[0, 0] = 2
+    a[12, 14] = 3
+    assert [k.tolist() for k in nputils.find_peaks(a, 2, 1, footprint='box')] == [[12, 14], [5, 5]]
+    assert [k.tolist() for k in nputils.find_peaks(a, 2, 1, exclude_border=False,
+                                                   footprint='box')] == [[12, 14], [0, 0], [5, 5]]
+
+    a = np.zeros([10, 10, 10])
+    a[0, 5, 5] = 1
+    a[5, 5, 9] = 1
+    a[4, 4, 4] = 1
+    assert [k.tolist() for k in nputils.find_peaks(a, 2, 0.5, footprint='box')] == [[4, 4, 4]]
+
+    a = np.random.random([50, 50])
+    peaks = nputils.find_peaks(a, 3, 0.5, exclude_border_dist=3, footprint='box')
+    for peak in peaks:
+        x, y = peak
+        assert 3 <= x < 47 and 3 <= y < 47
+        assert a[x, y] == a[x - 3:x + 4, y - 3:y + 4].max()
+
+
+def test_find_peaks_fit_gaussian():
+    centers = [[10.3, 12.6], [20.4, 40.2], [30.8, 25.1]]
+    a = sum([imgutils.gaussian([50, 50], width=4, center=c) for c in centers])
+
+    peaks = nputils.find_peaks(a, 3, 0.5, fit_gaussian=True)
+    assert np.allclose(sorted(np.array(peaks).tolist()), centers, atol=1e-2)
+
+    peaks = nputils.find_peaks(a, 3, 0.5, fit_gaussian=True, fit_gaussian_n=1)
+    assert np.allclose(sorted(np.array(peaks).tolist()), centers, atol=1e-2)
+
+    peaks = nputils.find_peaks(a, 3, 0.5, fit_gaussian='exact')
+    assert np.allclose(sorted(np.array(peaks).tolist()), centers, atol=1e-2)
+
+    assert nputils.fit_gaussian_on_peaks(a, []).shape == (0, 2)
+    x = nputils.gaussian_fct(0, 1, 12.4, 1.5)(np.arange(30))
+    assert np.allclose(nputils.fit_gaussian_on_peaks(x, [[12]]), [[12.4]])
+
+
 def test_align_on_com():
     a1 = _a([1, 1, 2, 1, 1])
     a2 = _a([1, 2, 1, 0, 0])
@@ -6,8 +6,9 @@ Created on Feb 15, 2012
 
 import pywt
 import numpy as np
+import astropy.io.fits as pyfits
 
-from libwise import nputils, wtutils, wavelets
+from libwise import nputils, wtutils, wavelets, imgutils
 from libwise.nputils import assert_equal
 
 
@@ -24,6 +25,26 @@ def get_all_boundaries():
     return [('zero', 'zpd'), ('symm', 'sym'), ('wrap', 'ppd')]
 
 
+def test_wavelet_registry():
+    w = wavelets.get_wavelet('db3')
+    assert w is wavelets.get_wavelet('db3')
+    assert w is wtutils.get_wavelet_obj('db3')
+    assert w is wavelets.DaubechiesWaveletFamily().get_wavelet('db3')
+    assert wavelets.get_wavelet('unknown') is None
+    nputils.assert_raise(ValueError, wtutils.get_wavelet_obj, 'unknown')
+
+    hkd, gkd, hkr, gkr = w.get_filters()
+    assert np.allclose(hkr, wavelets.wc.daubechies['db3'])
+    assert np.allclose(gkr, nputils.qmf(wavelets.wc.daubechies['db3']))
+    assert np.array_equal(hkd, hkr[::-1]) and np.array_equal(gkd, gkr[::-1])
+    assert w.get_dec_hk() is hkd and not hkd.flags.writeable
+    hkd32 = w.get_dec_hk(np.float32)
+    assert hkd32.dtype == np.float32 and hkd32.flags.c_contiguous
+    assert w.get_dec_hk(np.float32) is hkd32
+    assert not w.hk.flags.writeable and not w.gk.flags.writeable
+    assert not any(a.flags.writeable for a in w.get_wavelet_fct(3))
+
+
 def test_dwt_idwt_1d():
     for w in get_all_orthos_wavelets():
         for b_wt, b_pywt in get_all_boundaries():
@@ -85,3 +106,245 @@ def test_wavedec_uwt():
 def test_wavedec_iuwt():
     do_wavedec(wtutils.uiwt, wtutils.uiwt_inv)
 
+
+def test_wavedec_float32(monkeypatch):
+    img2d = np.random.random([64, 64])
+    img1d = nputils.random_walk(maxn=500)
+    for img, w, dec, rec in [(img2d, 'b1', wtutils.uiwt, wtutils.uiwt_inv),
+                             (img1d, 'db2', wtutils.uwt, wtutils.uwt_inv)]:
+        res = wtutils.wavedec(img, w, 3, dec=dec, dtype=np.float32)
+        assert all([k.dtype == np.float32 for k in res])
+        exp = wtutils.wavedec(img, w, 3, dec=dec)
+        for d, de in zip(res, exp):
+            assert np.allclose(d, de, rtol=1e-4, atol=1e-4)
+        rs = wtutils.waverec(res, w, rec=rec, dtype=np.float32)
+        assert rs.dtype == np.float32
+        assert np.allclose(rs, img, rtol=1e-4, atol=1e-4)
+
+    for cascade in [False, True]:
+        res = wtutils.dogdec(img2d, widths=[1, 2, 4], dtype=np.float32, cascade=cascade)
+        assert all([k.dtype == np.float32 for k in res])
+        exp = wtutils.dogdec(img2d, widths=[1, 2, 4], cascade=cascade)
+        for d, de in zip(res, exp):
+            assert np.allclose(d, de, rtol=1e-4, atol=1e-4)
+    stack = np.random.random([3, 32, 32])
+    monkeypatch.setattr(nputils, 'LINES_BLOCK_SIZE', 1)
+    res = wtutils.dogdec(stack, widths=[1, 2, 4], dtype=np.float32)
+    assert all([k.dtype == np.float32 for k in res])
+
+
+def test_wavedec_cube():
+    img = np.random.random([64, 48])
+    for dec in [wtutils.uiwt, wtutils.uimwt]:
+        for axis in [None, 1]:
+            exp = wtutils.wavedec(img, 'b3', 4, dec=dec, axis=axis)
+            res = wtutils.wavedec_cube(img, 'b3', 4, dec=dec, axis=axis)
+            assert res.shape == (5, 64, 48)
+            assert np.allclose(res, np.array(exp))
+
+    out = np.zeros([5, 64, 48], dtype=np.float32)
+    res = wtutils.wavedec(img, 'b3', 4, dec=wtutils.uiwt, out=out)
+    assert res is out
+    assert np.allclose(res.sum(axis=0), img, atol=1e-5)
+
+    nputils.assert_raise(ValueError, wtutils.wavedec_cube, img, 'db2', 3, 'symm', wtutils.uwt)
+
+
+def test_wavedec_workers():
+    img = np.random.random([128, 64])
+    for dec, rec, w in [(wtutils.dwt, wtutils.dwt_inv, 'db1'), (wtutils.uwt, wtutils.uwt_inv, 'db2'),
+                        (wtutils.uiwt, wtutils.uiwt_inv, 'b3')]:
+        exp = wtutils.wavedec(img, w, 3, dec=dec)
+        res = wtutils.wavedec(img, w, 3, dec=dec, workers=4)
+        assert all([np.array_equal(e, r) for e, r in zip(exp, res)])
+        assert np.array_equal(wtutils.waverec(res, w, rec=rec, workers=4), wtutils.waverec(exp, w, rec=rec))
+
+    coefs = wtutils.wavedec2d(img, 'db1', 3, workers=4)
+    assert np.allclose(wtutils.waverec2d(coefs, 'db1', shape=img.shape, workers=4), img)
+
+
+def test_wavedec_stack(monkeypatch):
+    stack = np.random.random([5, 32, 24])
+    # 1 image chunks, and a single chunk
+    for block_size in [stack[0].nbytes, nputils.LINES_BLOCK_SIZE]:
+        monkeypatch.setattr(nputils, 'LINES_BLOCK_SIZE', block_size)
+        for dec, w in [(wtutils.dwt, 'db2'), (wtutils.uwt, 'db2'), (wtutils.uimwt, 'b3')]:
+            for axis in [None, 1]:
+                res = wtutils.wavedec(stack, w, 3, dec=dec, axis=axis, stack=True)
+                for i, img in enumerate(stack):
+                    exp = wtutils.wavedec(img, w, 3, dec=dec, axis=axis)
+                    assert all([np.allclose(e, r[i]) for e, r in zip(exp, res)])
+
+        cube = wtutils.wavedec_cube(stack, 'b3', 3, stack=True)
+        assert cube.shape == (5, 4, 32, 24)
+        assert np.allclose(cube[2], wtutils.wavedec_cube(stack[2], 'b3', 3))
+
+        res = wtutils.dogdec(stack, widths=[1, 2, 4], angle=0.5, ellipticity=2)
+        exp = wtutils.dogdec(stack[3], widths=[1, 2, 4], angle=0.5, ellipticity=2)
+        assert all([np.allclose(e, r[3]) for e, r in zip(exp, res)])
+    monkeypatch.undo()
+
+    res = wtutils.wavedec2d(stack, 'db2', 2, stack=True)
+    exp = wtutils.wavedec2d(stack[1], 'db2', 2)
+    assert np.allclose(exp[-1], res[-1][1])
+    assert all([np.allclose(e, r[1]) for e, r in zip(exp[0], res[0])])
+
+
+def test_noise_factor(tmpdir):
+    wtutils.NOISE_FACTOR_TABLE = dict()
+    beam = imgutils.GaussianBeam(4, 2, 0.3)
+    noise = beam.convolve(nputils.gaussian_noise([600, 600], 0, 1))
+    for dec, w in [(wtutils.uiwt, 'b3'), (wtutils.uimwt, 'b3'), (wtutils.uwt, 'db2')]:
+        factors = wtutils.get_noise_factor(w, 3, dec, beam=beam)
+        scales = wtutils.wavedec(noise, w, 3, dec=dec)
+        exp = [s[60:-60, 60:-60].std() for s in scales[:-1]]
+        assert np.allclose(factors, exp, rtol=0.05)
+        assert wtutils.get_noise_factor(w, 3, dec, beam=beam) == factors
+    assert np.allclose(wtutils.get_noise_factor('db2', 2, wtutils.uwt, dec2d=True), 1)
+    assert len(wtutils.NOISE_FACTOR_TABLE) == 4
+
+    factors = wtutils.dog_noise_factor(1, widths=[1, 2, 4, 8])
+    assert len(factors) == 2
+    assert np.allclose(wtutils.dog_noise_factor(2, widths=[1, 2, 4, 8]), 2 * np.array(factors))
+    assert len(wtutils.NOISE_FACTOR_TABLE) == 5
+
+    # lambdas, and beams of an other backend, are not mixed up
+    wtutils.dec_noise_factor(lambda bg: [bg, bg], 1)
+    assert len(wtutils.NOISE_FACTOR_TABLE) == 5
+    wtutils.get_noise_factor('b3', 3, wtutils.uiwt, beam=imgutils.GaussianBeam(4, 2, 0.3, backend='fft'))
+    assert len(wtutils.NOISE_FACTOR_TABLE) == 6
+
+    filename = str(tmpdir.join('noise_factors.json'))
+    wtutils.save_noise_factors(filename)
+    table = wtutils.NOISE_FACTOR_TABLE
+    assert wtutils.load_noise_factors(filename)
+    assert wtutils.NOISE_FACTOR_TABLE == table
+    wtutils.NOISE_FACTOR_VERSION += 1
+    try:
+        assert not wtutils.load_noise_factors(filename)
+        assert wtutils.NOISE_FACTOR_TABLE == dict()
+    finally:
+        wtutils.NOISE_FACTOR_VERSION -= 1
+    assert not wtutils.load_noise_factors(filename + '.missing')
+    assert wtutils.NOISE_FACTOR_TABLE == dict()
+
+
+def test_batch_denoise(tmpdir):
+    filenames = [str(tmpdir.join('img%s.fits' % i)) for i in range(3)]
+    output_filenames = [str(tmpdir.join('img%s.denoised.fits' % i)) for i in range(3)]
+    images = []
+    for filename in filenames:
+        data = imgutils.gaussian(64, width=10) + nputils.gaussian_noise((64, 64), 0, 0.05)
+        imgutils.Image(data).save_to_fits(filename)
+        images.append(imgutils.guess_and_open(filename).data)
+
+    dec, rec = wtutils.get_denoise_transforms('b3')
+    assert dec == wtutils.uiwt
+    denoise = wtutils.Denoise('b3', 3, dec=dec, rec=rec)
+    done = []
+    results = wtutils.batch_denoise(denoise, filenames + ['missing.fits'],
+                                    output_filenames + ['missing.denoised.fits'], workers=2,
+                                    progress=lambda *args: done.append(args[:2]))
+    assert sorted(done) == [(i, 4) for i in range(1, 5)]
+    assert sorted(r[0] for r in results if r[2] is not None) == ['missing.fits']
+    nputils.assert_raise(ValueError, wtutils.batch_denoise, denoise, filenames[:2],
+                         [output_filenames[0]] * 2)
+    for data, output_filename in zip(images, output_filenames):
+        exp = wtutils.Denoise('b3', 3, dec=dec, rec=rec).do(data)
+        assert np.allclose(imgutils.guess_and_open(output_filename).data, exp)
+
+    # thread pools of the parent are not used by the worker processes
+    nputils.set_workers(2)
+    try:
+        nputils.get_thread_pool(2)
+        results = wtutils.batch_denoise(denoise, filenames, output_filenames, workers=2)
+        assert all(r[2] is None for r in results)
+    finally:
+        nputils.set_workers(1)
+
+
+def test_dogdec_cascade():
+    img = np.random.random([128, 128])
+    widths = [2, 4, 8, 16]
+    exp = wtutils.dogdec(img, widths=widths)
+    for cascade, backend in [(True, 'fir'), (False, 'iir'), (True, 'iir')]:
+        res = wtutils.dogdec(img, widths=widths, cascade=cascade, backend=backend)
+        for e, r in zip(exp, res):
+            assert np.allclose(e[30:-30, 30:-30], r[30:-30, 30:-30], atol=2e-3 * abs(e).max())
+    nputils.assert_raise(ValueError, wtutils.dogdec, img, [4, 2], 0, 1, 'symm', None, True)
+
+
+def test_lapdec():
+    img = np.random.random([101, 64])
+    for boundary in ['symm', 'zero', 'wrap']:
+        coefs = wtutils.lapdec(img, 4, boundary=boundary)
+        assert [c.shape for c in coefs] == [(101, 64), (51, 32), (26, 16), (13, 8), (7, 4)]
+        assert np.allclose(wtutils.laprec(coefs, boundary=boundary), img)
+
+    img = imgutils.gaussian((128, 128), width=10, center=(80, 40))
+    for k, g in enumerate(wtutils.gaussian_pyramid(img, 2)):
+        assert np.array_equal(wtutils.pyramid_to_pixel(nputils.coord_max(g), k), [80, 40])
+        assert np.allclose(wtutils.pixel_to_pyramid([80, 40], k), np.array([80, 40]) / 2. ** k)
+
+    assert len(wtutils.pyramiddec(img, widths=[1, 2, 4], angle=0.3, ellipticity=2)) == 2
+
+
+def test_wavedec_memmap(tmpdir):
+    filename = str(tmpdir.join('dec.npy'))
+    img = np.random.random([64, 48])
+    exp = wtutils.wavedec_cube(img, 'b3', 4, dec=wtutils.uimwt)
+
+    res = wtutils.wavedec_memmap(img, 'b3', 4, filename, dec=wtutils.uimwt)
+    assert isinstance(res, np.memmap)
+    assert np.allclose(res, exp)
+    del res
+
+    cube = wtutils.open_wavedec(filename)
+    assert isinstance(cube, np.memmap)
+    assert cube.shape == (5, 64, 48)
+    assert np.allclose(cube[2], exp[2])
+    assert np.allclose(cube[3, 10:20, 5:15], exp[3, 10:20, 5:15])
+
+
+def test_wavedec_strips(tmpdir):
+    img = np.random.random([150, 60])
+    for dec in [wtutils.uiwt, wtutils.uimwt]:
+        for boundary in ['symm', 'zero', 'wrap']:
+            exp = wtutils.wavedec_cube(img, 'b3', 4, boundary=boundary, dec=dec)
+            out = np.zeros_like(exp)
+            wtutils.wavedec_strips(img, 'b3', 4, out, strip_size=32, boundary=boundary, dec=dec)
+            assert np.array_equal(out, exp)
+
+    fits_file = str(tmpdir.join('img.fits'))
+    pyfits.PrimaryHDU(img[np.newaxis, np.newaxis]).writeto(fits_file)
+    reader = imgutils.FitsStripReader(fits_file)
+    assert reader.shape == (150, 60)
+    assert np.array_equal(reader[10:20], img[10:20])
+    assert np.array_equal(reader[[149, 0, 1]], img[[149, 0, 1]])
+
+    out = wtutils.wavedec_strips(reader, 'b3', 4, unicode(tmpdir.join('dec.npy')), strip_size=40)
+    reader.close()
+    assert isinstance(out, np.memmap)
+    assert np.array_equal(out, wtutils.wavedec_cube(img, 'b3', 4))
+
+    class SectionSpy(object):
+
+        def __init__(self, section):
+            self.section = section
+            self.n_rows = []
+
+        def __getitem__(self, key):
+            data = self.section[key]
+            self.n_rows.append(data.shape[-2])
+            return data
+
+    reader = imgutils.FitsStripReader(fits_file)
+    spy = SectionSpy(reader.hdu.section)
+    reader.hdu = type('HDU', (object,), {'section': spy})()
+    halo = wtutils.get_strip_halo('b3', 2)
+    out = np.zeros([3, 150, 60])
+    wtutils.wavedec_strips(reader, 'b3', 2, out, strip_size=40, boundary='wrap')
+    reader.close()
+    assert np.allclose(out, wtutils.wavedec_cube(img, 'b3', 2, boundary='wrap'))
+    assert sum(spy.n_rows) == 150 + 2 * halo * 4
+    assert max(spy.n_rows) <= 40 + 2 * halo